@@ -0,0 +1,267 @@
+from __future__ import annotations
+
+import json
+import struct
+from pathlib import Path
+from typing import Any, Generator
+
+import numpy as np
+
+MAGIC = b"SAEACTS1"
+HEADER_BYTES = 4096
+_LEN = struct.Struct("<I")
+
+
+class ActivationStore:
+    """
+    Self-describing on-disk activation matrix.
+
+    Layout: a fixed HEADER_BYTES header (MAGIC, uint32 length, JSON with dtype, d_model,
+    n_tokens, capacity, layer_index, activation_stream, model_name, model_hash) followed by
+    a row-major [capacity, d_model] array. Only the first n_tokens rows are valid.
+
+    Files written before the header existed (raw float16 memmaps) are still readable when
+    d_model and n_tokens are supplied, e.g. from meta_{label}.json.
+    """
+
+    def __init__(self, path: Path, header: dict[str, Any], buffer: np.memmap, legacy: bool = False):
+        self.path = path
+        self.header = header
+        self.buffer = buffer
+        self.legacy = legacy
+
+    @classmethod
+    def create(cls, path: str | Path, capacity: int, d_model: int, dtype: str = "float16", **info: Any) -> "ActivationStore":
+        path = Path(path)
+        header = {
+            "dtype": np.dtype(dtype).name,
+            "d_model": int(d_model),
+            "n_tokens": 0,
+            "capacity": int(capacity),
+            **info,
+        }
+        with open(path, "wb") as f:
+            f.write(_encode_header(header))
+            f.truncate(HEADER_BYTES + int(capacity) * int(d_model) * np.dtype(dtype).itemsize)
+        buffer = np.memmap(path, mode="r+", dtype=np.dtype(dtype), offset=HEADER_BYTES, shape=(int(capacity), int(d_model)))
+        return cls(path, header, buffer)
+
+    @classmethod
+    def open(
+        cls,
+        path: str | Path,
+        mode: str = "r",
+        d_model: int | None = None,
+        n_tokens: int | None = None,
+    ) -> "ActivationStore":
+        path = Path(path)
+        with open(path, "rb") as f:
+            head = f.read(HEADER_BYTES)
+
+        if head[: len(MAGIC)] == MAGIC:
+            (length,) = _LEN.unpack_from(head, len(MAGIC))
+            start = len(MAGIC) + _LEN.size
+            header = json.loads(head[start : start + length].decode("utf-8"))
+            dtype = np.dtype(header["dtype"])
+            shape = (int(header["capacity"]), int(header["d_model"]))
+            buffer = np.memmap(path, mode=mode, dtype=dtype, offset=HEADER_BYTES, shape=shape)
+            return cls(path, header, buffer)
+
+        if d_model is None:
+            raise ValueError(f"{path} has no activation-store header; pass d_model (and n_tokens) to open it.")
+        dtype = np.dtype(np.float16)
+        capacity = path.stat().st_size // (int(d_model) * dtype.itemsize)
+        header = {
+            "dtype": dtype.name,
+            "d_model": int(d_model),
+            "n_tokens": int(capacity if n_tokens is None else n_tokens),
+            "capacity": int(capacity),
+        }
+        buffer = np.memmap(path, mode=mode, dtype=dtype, shape=(int(capacity), int(d_model)))
+        return cls(path, header, buffer, legacy=True)
+
+    def __len__(self) -> int:
+        return int(self.header["n_tokens"])
+
+    @property
+    def d_model(self) -> int:
+        return int(self.header["d_model"])
+
+    @property
+    def dtype(self) -> np.dtype:
+        return np.dtype(self.header["dtype"])
+
+    @property
+    def array(self) -> np.memmap:
+        """Zero-copy view of the valid rows."""
+        return self.buffer[: len(self)]
+
+    def finalize(self, n_tokens: int) -> None:
+        """Record how many rows were written and flush data + header to disk."""
+        if n_tokens > int(self.header["capacity"]):
+            raise ValueError(f"n_tokens={n_tokens} exceeds store capacity {self.header['capacity']}.")
+        self.header["n_tokens"] = int(n_tokens)
+        self.buffer.flush()
+        with open(self.path, "r+b") as f:
+            f.write(_encode_header(self.header))
+
+    def iter_chunks(
+        self, chunk_rows: int, start: int = 0, stop: int | None = None
+    ) -> Generator[tuple[int, np.memmap], None, None]:
+        """Yield (row_offset, view) over [start, stop) in contiguous zero-copy chunks."""
+        stop = len(self) if stop is None else min(stop, len(self))
+        for lo in range(start, stop, max(chunk_rows, 1)):
+            yield lo, self.buffer[lo : min(lo + chunk_rows, stop)]
+
+    def sample(self, n: int, rng: np.random.Generator) -> np.ndarray:
+        """
+        Return `n` distinct random rows, drawn as `rng.choice(len(self), n, replace=False)`.
+
+        Rows are read from disk in sorted order and returned in draw order.
+        """
+        idx = rng.choice(len(self), size=n, replace=False)
+        order = np.argsort(idx)
+        out = np.empty((len(idx), self.d_model), dtype=self.dtype)
+        out[order] = self.buffer[idx[order]]
+        return out
+
+
+def _encode_header(header: dict[str, Any]) -> bytes:
+    payload = json.dumps(header, sort_keys=True).encode("utf-8")
+    raw = MAGIC + _LEN.pack(len(payload)) + payload
+    if len(raw) > HEADER_BYTES:
+        raise ValueError(f"Activation-store header is {len(raw)} bytes; limit is {HEADER_BYTES}.")
+    return raw.ljust(HEADER_BYTES, b"\0")
+
+
+def open_label_store(acts_dir: str | Path, label: str, cfg=None) -> tuple[ActivationStore, dict]:
+    """
+    Open the activations collected for `label` under `acts_dir`; returns (store, meta_{label}.json).
+
+    The header's d_model and model hash must agree with the metadata file and, given `cfg`, its
+    model name, layer and stream with `cfg.model`; a mismatch (a stale or foreign store) raises
+    ValueError. Header-less stores carry none of these fields and are not checked.
+    """
+    with open(Path(acts_dir) / f"meta_{label}.json", "r", encoding="utf-8") as f:
+        meta = json.load(f)
+    store = ActivationStore.open(meta["acts_path"], d_model=int(meta["d_model"]), n_tokens=int(meta["tokens_collected"]))
+    expected = {"d_model": meta.get("d_model"), "model_hash": meta.get("model_hash")}
+    if cfg is not None:
+        expected["model_name"] = cfg.model.model_name
+        expected["layer_index"] = cfg.model.layer_index
+        expected["activation_stream"] = cfg.model.activation_stream
+    bad = [
+        f"{key}={store.header[key]!r} (expected {value!r})"
+        for key, value in expected.items()
+        if value is not None and key in store.header and store.header[key] != value
+    ]
+    if bad:
+        raise ValueError(f"{store.path} does not match the current run: {', '.join(bad)}. Re-run src.collect_acts.")
+    return store, meta
+
+
+class BlockShuffleSampler:
+    """
+    Training batches over rows [start, stop) of a store, shuffled at block granularity.
+
+    Each epoch the `block_rows`-row blocks are put in random order and consumed
+    `buffer_rows // block_rows` at a time. The blocks of one buffer are read in ascending
+    file order (sequential page-cache reads), moved to the device in their stored dtype,
+    upcast, and permuted once into a single contiguous tensor. Batches are then plain
+    slices of that tensor, with no per-row indexing or collation.
+
+    With shuffle=False blocks and rows keep file order (used for validation).
+    Shuffling is a pure function of (seed, epoch).
+
+    For data-parallel training, rank r of world_size takes every world_size-th block of the
+    epoch's order. With equalize=True every rank stops after the smallest rank's batch count,
+    so all ranks take the same number of optimizer steps; `dropped_rows` counts what that skips.
+    """
+
+    def __init__(
+        self,
+        store: ActivationStore,
+        start: int,
+        stop: int,
+        batch_size: int,
+        block_rows: int,
+        buffer_rows: int,
+        device,
+        seed: int = 0,
+        shuffle: bool = True,
+        rank: int = 0,
+        world_size: int = 1,
+        equalize: bool = True,
+    ):
+        self.store = store
+        self.batch_size = batch_size
+        self.device = device
+        self.seed = seed
+        self.shuffle = shuffle
+        self.rank = rank
+        self.world_size = world_size
+        self.equalize = equalize
+        self.blocks = [(lo, min(lo + block_rows, stop)) for lo in range(start, stop, max(block_rows, 1))]
+        self.blocks_per_buffer = max(buffer_rows // max(block_rows, 1), 1)
+
+    def _buffers(self, epoch: int, rank: int | None = None) -> list[list[tuple[int, int]]]:
+        order = np.arange(len(self.blocks))
+        if self.shuffle:
+            np.random.default_rng([self.seed, epoch]).shuffle(order)
+        order = order[self.rank if rank is None else rank :: self.world_size]
+        groups = [order[i : i + self.blocks_per_buffer] for i in range(0, len(order), self.blocks_per_buffer)]
+        return [[self.blocks[b] for b in (sorted(g) if self.shuffle else g)] for g in groups]
+
+    def _rank_batches(self, epoch: int, rank: int | None = None) -> int:
+        return sum(-(-sum(hi - lo for lo, hi in group) // self.batch_size) for group in self._buffers(epoch, rank))
+
+    def num_batches(self, epoch: int = 0) -> int:
+        """Batches yielded by `iter_epoch(epoch)` (the short last block can shift this by one per epoch)."""
+        if self.world_size > 1 and self.equalize:
+            return min(self._rank_batches(epoch, r) for r in range(self.world_size))
+        return self._rank_batches(epoch)
+
+    def __len__(self) -> int:
+        return self.num_batches(0)
+
+    def dropped_rows(self, epoch: int = 0) -> int:
+        """Rows of the epoch that no rank reads because equalize=True stops the larger shards early."""
+        if self.world_size == 1 or not self.equalize:
+            return 0
+        n_batches = self.num_batches(epoch)
+        kept = 0
+        for rank in range(self.world_size):
+            left = n_batches
+            for group in self._buffers(epoch, rank):
+                rows = sum(hi - lo for lo, hi in group)
+                taken = min(left, -(-rows // self.batch_size))
+                kept += min(rows, taken * self.batch_size)
+                left -= taken
+        return sum(hi - lo for lo, hi in self.blocks) - kept
+
+    def iter_epoch(self, epoch: int = 0, start_batch: int = 0):
+        """Yield the epoch's batches, optionally resuming at `start_batch` (whole buffers before it are not read)."""
+        import torch
+
+        gen = torch.Generator().manual_seed(self.seed * 1_000_003 + epoch)
+        skip = start_batch
+        remaining = self.num_batches(epoch) - start_batch
+        for group in self._buffers(epoch):
+            if remaining <= 0:
+                return
+            rows = sum(hi - lo for lo, hi in group)
+            perm = torch.randperm(rows, generator=gen) if self.shuffle else None
+            n_batches = -(-rows // self.batch_size)
+            if skip >= n_batches:
+                skip -= n_batches
+                continue
+            host = np.concatenate([self.store.buffer[lo:hi] for lo, hi in group])
+            buf = torch.from_numpy(host).to(self.device).float()
+            if perm is not None:
+                buf = buf[perm.to(self.device)]
+            for i in range(skip * self.batch_size, buf.shape[0], self.batch_size):
+                if remaining <= 0:
+                    return
+                yield buf[i : i + self.batch_size]
+                remaining -= 1
+            skip = 0
@@ -35,9 +35,9 @@ def intervention_hook_factory(sae: SparseAutoencoder, feature_idx: int, alpha: f
         x = out
         orig_dtype = x.dtype
         with torch.no_grad():
-            h = sae.encode(x.float())
+            h = sae.encode_inference(x.float())
             h[..., feature_idx] = h[..., feature_idx] * alpha
-            recon = sae.decoder(h)
+            recon = sae.decode(h)
         return recon.to(orig_dtype)
 
     return hook
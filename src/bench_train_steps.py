@@ -0,0 +1,91 @@
+from __future__ import annotations
+
+import argparse
+import json
+import time
+
+import torch
+
+from .config import load_config
+from .sae import SparseAutoencoder
+from .train_sae import _accumulate, _build_loss_fn, _make_scaler, _train_step
+from .utils import get_device, set_seed
+
+
+def _sync(device: torch.device) -> None:
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    elif device.type == "mps":
+        torch.mps.synchronize()
+
+
+def _steps_per_sec(cfg, d_model: int, steps: int, warmup: int, per_step_sync: bool, device) -> float:
+    set_seed(cfg.seed)
+    model = SparseAutoencoder(
+        d_model=d_model,
+        d_sae=cfg.sae.d_sae,
+        sparsity_mode=cfg.sae.sparsity_mode,
+        topk=cfg.sae.topk,
+    ).to(device)
+    optim = torch.optim.AdamW(model.parameters(), lr=cfg.sae.lr, weight_decay=cfg.sae.weight_decay)
+    sched = torch.optim.lr_scheduler.CosineAnnealingLR(optim, T_max=steps + warmup)
+    scaler = _make_scaler(cfg.sae, device)
+    loss_fn = _build_loss_fn(model, cfg.sae, device)
+    # Synthetic activations: a fixed pool of batches so data movement is not measured.
+    pool = torch.randn(16, cfg.sae.batch_size, d_model, device=device)
+    sums = torch.zeros(2, device=device)
+    recon_sum = l1_sum = 0.0
+
+    for i in range(warmup + steps):
+        if i == warmup:
+            _sync(device)
+            t0 = time.perf_counter()
+        xb = pool[i % pool.shape[0]]
+        loss_out = _train_step(model, optim, sched, scaler, loss_fn, xb, cfg.sae.grad_clip)
+        if per_step_sync:
+            recon_sum += float(loss_out.recon.item()) * xb.shape[0]
+            l1_sum += float(loss_out.l1.item()) * xb.shape[0]
+        else:
+            _accumulate(sums, loss_out, xb.shape[0])
+            if cfg.sae.log_every > 0 and (i + 1) % cfg.sae.log_every == 0:
+                sums.tolist()
+    sums.tolist()
+    _sync(device)
+    return steps / (time.perf_counter() - t0)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Compare SAE train-step throughput with and without per-step host syncs.")
+    parser.add_argument("--config", required=True)
+    parser.add_argument("--d-model", type=int, default=512, help="Width of the synthetic activations (pythia-70m: 512).")
+    parser.add_argument("--steps", type=int, default=500)
+    parser.add_argument("--warmup", type=int, default=20)
+    args = parser.parse_args()
+
+    cfg = load_config(args.config)
+    device = get_device(cfg.device_preference)
+
+    sync_sps = _steps_per_sec(cfg, args.d_model, args.steps, args.warmup, True, device)
+    accum_sps = _steps_per_sec(cfg, args.d_model, args.steps, args.warmup, False, device)
+    print(
+        json.dumps(
+            {
+                "device": str(device),
+                "d_model": args.d_model,
+                "d_sae": cfg.sae.d_sae,
+                "batch_size": cfg.sae.batch_size,
+                "log_every": cfg.sae.log_every,
+                "precision": cfg.sae.precision,
+                "compile": cfg.sae.compile,
+                "steps": args.steps,
+                "per_step_sync_steps_per_sec": sync_sps,
+                "accumulated_steps_per_sec": accum_sps,
+                "speedup": accum_sps / max(sync_sps, 1e-12),
+            },
+            indent=2,
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
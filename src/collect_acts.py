@@ -2,94 +2,283 @@ from __future__ import annotations
 
 import argparse
 import json
+import queue
+import threading
 import time
+from contextlib import nullcontext
+from dataclasses import dataclass
 from pathlib import Path
 
 import numpy as np
 import torch
 from tqdm import tqdm
 
+from .activation_store import ActivationStore
 from .config import load_config
-from .data import TextStreamSpec, load_text_stream, token_batches
-from .model import activation_collector, load_model_and_tokenizer
+from .data import (
+    BatchPrefetcher,
+    TextStreamSpec,
+    TokenShards,
+    load_text_stream,
+    materialize_token_shards,
+    shard_token_batches,
+    token_batches,
+)
+from .model import (
+    load_model_and_tokenizer,
+    load_tokenizer,
+    model_fingerprint,
+    multi_activation_collector,
+    truncated_forward,
+)
 from .utils import get_device, set_seed
 
 
-def _collect_one_dataset(cfg, label: str, spec: TextStreamSpec, tokens_target: int) -> dict:
-    out_dir = Path(cfg.collection.output_dir)
-    out_dir.mkdir(parents=True, exist_ok=True)
+def _shard_dir(cfg, label: str) -> Path:
+    return Path(cfg.data.token_shards_dir) / label
 
-    device = get_device(cfg.device_preference)
-    hooked = load_model_and_tokenizer(cfg.model.model_name, cfg.model.dtype, device)
 
-    d_model = int(hooked.model.config.hidden_size)
-    acts_path = out_dir / f"acts_{label}.mmap"
-    toks_path = out_dir / f"tokens_{label}.npy"
+def _materialize(cfg, label: str, spec: TextStreamSpec, tokenizer) -> TokenShards:
+    out_dir = _shard_dir(cfg, label)
+    meta = materialize_token_shards(spec, tokenizer, out_dir, encode_batch_size=cfg.collection.tokenize_batch_size)
+    print(f"[{label}] materialized {meta['n_tokens']} tokens from {meta['n_texts']} texts into {out_dir}")
+    return TokenShards(out_dir)
 
-    acts_mmap = np.memmap(acts_path, mode="w+", dtype=np.float16, shape=(tokens_target, d_model))
-    token_ids = np.zeros((tokens_target,), dtype=np.int32)
 
-    text_iter = load_text_stream(spec)
-    batches = token_batches(
-        text_iter,
-        tokenizer=hooked.tokenizer,
+def _token_batches(cfg, label: str, spec: TextStreamSpec, tokenizer, tokens_target: int):
+    if not cfg.data.token_shards_dir:
+        return token_batches(
+            load_text_stream(spec),
+            tokenizer=tokenizer,
+            seq_len=cfg.collection.seq_len,
+            batch_size=cfg.collection.batch_size,
+            total_tokens_target=tokens_target,
+            encode_batch_size=cfg.collection.tokenize_batch_size,
+            num_workers=cfg.collection.num_workers,
+        )
+
+    if (_shard_dir(cfg, label) / "meta.json").exists():
+        shards = TokenShards(_shard_dir(cfg, label))
+        shards.check_matches(spec, tokenizer)
+    else:
+        shards = _materialize(cfg, label, spec, tokenizer)
+    return shard_token_batches(
+        shards,
         seq_len=cfg.collection.seq_len,
         batch_size=cfg.collection.batch_size,
         total_tokens_target=tokens_target,
     )
 
-    idx = 0
-    t0 = time.time()
-
-    with torch.inference_mode(), activation_collector(
-        hooked.model, cfg.model.layer_index, cfg.model.activation_stream
-    ) as acts:
-        pbar = tqdm(desc=f"collect:{label}", total=tokens_target)
-        for input_ids, attention_mask, _ in batches:
-            if idx >= tokens_target:
-                break
-            input_ids = input_ids.to(device)
-            attention_mask = attention_mask.to(device)
-            _ = hooked.model(input_ids=input_ids, attention_mask=attention_mask)
-
-            layer_act = acts.pop()
-            layer_act = layer_act.float().cpu().numpy().reshape(-1, d_model)
-            toks = input_ids.detach().cpu().numpy().reshape(-1)
-
-            n = min(layer_act.shape[0], tokens_target - idx)
-            acts_mmap[idx : idx + n] = layer_act[:n].astype(np.float16)
-            token_ids[idx : idx + n] = toks[:n]
-            idx += n
-            pbar.update(n)
-        pbar.close()
-
-    acts_mmap.flush()
-    np.save(toks_path, token_ids[:idx])
-
-    elapsed = time.time() - t0
-    mb = (idx * d_model * 2) / (1024 * 1024)
-    meta = {
-        "label": label,
-        "tokens_collected": idx,
-        "d_model": d_model,
-        "acts_path": str(acts_path),
-        "tokens_path": str(toks_path),
-        "dtype": "float16",
-        "throughput_tokens_per_sec": idx / max(elapsed, 1e-6),
-        "storage_mb": mb,
-        "model_name": cfg.model.model_name,
-        "layer_index": cfg.model.layer_index,
-        "activation_stream": cfg.model.activation_stream,
-    }
-    with open(out_dir / f"meta_{label}.json", "w", encoding="utf-8") as f:
-        json.dump(meta, f, indent=2)
-    print(f"[{label}] tokens={idx} throughput={meta['throughput_tokens_per_sec']:.1f}/s storage={mb:.1f}MB")
-    return meta
+
+class _WriteBehind:
+    """
+    Stream device activations into a float16 memmap without blocking the forward loop.
+
+    Each batch is cast to float16 on the device (a no-op for float16 models), copied into
+    one of `depth` host staging slots (pinned + non_blocking on CUDA), and flushed into
+    the memmap by a writer thread while the next forward runs.
+    """
+
+    def __init__(self, mmap: np.ndarray, rows: int, device: torch.device, depth: int = 2):
+        self._mmap = mmap
+        self._pinned = device.type == "cuda"
+        d_model = mmap.shape[1]
+        self._slots = [
+            torch.empty((rows, d_model), dtype=torch.float16, pin_memory=self._pinned) for _ in range(depth)
+        ]
+        self._free: queue.Queue = queue.Queue()
+        for i in range(depth):
+            self._free.put(i)
+        self._jobs: queue.Queue = queue.Queue()
+        self._error: BaseException | None = None
+        self._thread = threading.Thread(target=self._run, name="acts-writer", daemon=True)
+        self._thread.start()
+
+    def submit(self, act: torch.Tensor, start: int, n: int) -> None:
+        if self._error is not None:
+            raise self._error
+        slot = self._free.get()
+        host = self._slots[slot]
+        src = act.reshape(-1, host.shape[1])[:n].to(torch.float16)
+        host[:n].copy_(src, non_blocking=self._pinned)
+        event = None
+        if self._pinned:
+            event = torch.cuda.Event()
+            event.record()
+        self._jobs.put((slot, start, n, event))
+
+    def _run(self) -> None:
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                return
+            slot, start, n, event = job
+            try:
+                if event is not None:
+                    event.synchronize()
+                self._mmap[start : start + n] = self._slots[slot][:n].numpy()
+            except BaseException as e:  # re-raised on the collection thread
+                self._error = e
+            finally:
+                self._free.put(slot)
+
+    def close(self) -> None:
+        self._jobs.put(None)
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+
+
+@dataclass(frozen=True)
+class Site:
+    layer_index: int
+    stream: str
+    out_dir: Path
+
+
+def _resolve_sites(cfg, layers: str | None, streams: str | None, output_template: str | None) -> list[Site]:
+    layer_list = [int(x) for x in layers.split(",") if x.strip()] if layers else [cfg.model.layer_index]
+    stream_list = [x.strip() for x in streams.split(",") if x.strip()] if streams else [cfg.model.activation_stream]
+    if output_template is None:
+        single = len(layer_list) == 1 and len(stream_list) == 1
+        output_template = "{output_dir}" if single else "{output_dir}/layer_{layer}/{stream}"
+
+    sites = [
+        Site(
+            layer_index=layer,
+            stream=stream,
+            out_dir=Path(output_template.format(output_dir=cfg.collection.output_dir, layer=layer, stream=stream)),
+        )
+        for layer in layer_list
+        for stream in stream_list
+    ]
+    if len({site.out_dir for site in sites}) != len(sites):
+        raise ValueError(f"--output-template {output_template!r} maps several sites to the same directory.")
+    return sites
+
+
+class CollectionSession:
+    """
+    Load the model and tokenizer once and stream any number of labelled datasets through them.
+
+    Every `collect` call writes one memmap + token file + metadata per site.
+    """
+
+    def __init__(self, cfg, sites: list[Site]):
+        self.cfg = cfg
+        self.sites = sites
+        self.device = get_device(cfg.device_preference)
+        t0 = time.time()
+        self.hooked = load_model_and_tokenizer(cfg.model.model_name, cfg.model.dtype, self.device)
+        model = self.hooked.model  # weights load on first access; keep that inside model_load_sec
+        self.model_load_sec = time.time() - t0
+        self.d_model = int(model.config.hidden_size)
+        self.model_hash = model_fingerprint(model)
+
+    def collect(self, label: str, spec: TextStreamSpec, tokens_target: int) -> dict[Site, dict]:
+        """Collect every site from one forward pass per batch; returns per-site metadata."""
+        cfg, sites, device, hooked, d_model = self.cfg, self.sites, self.device, self.hooked, self.d_model
+        rows = cfg.collection.seq_len * cfg.collection.batch_size
+        stores: dict[Site, ActivationStore] = {}
+        writers: dict[Site, _WriteBehind] = {}
+        for site in sites:
+            site.out_dir.mkdir(parents=True, exist_ok=True)
+            stores[site] = ActivationStore.create(
+                site.out_dir / f"acts_{label}.mmap",
+                capacity=tokens_target,
+                d_model=d_model,
+                dtype="float16",
+                label=label,
+                layer_index=site.layer_index,
+                activation_stream=site.stream,
+                model_name=cfg.model.model_name,
+                model_hash=self.model_hash,
+            )
+            writers[site] = _WriteBehind(stores[site].buffer, rows=rows, device=device)
+        token_ids = np.zeros((tokens_target,), dtype=np.int32)
+
+        # num_workers > 0 moves batch construction onto a producer thread that runs ahead of the model.
+        prefetch_depth = cfg.collection.prefetch_batches if cfg.collection.num_workers > 0 else 0
+        batches = BatchPrefetcher(_token_batches(cfg, label, spec, hooked.tokenizer, tokens_target), depth=prefetch_depth)
+
+        idx = 0
+        t0 = time.time()
+
+        site_keys = [(site.layer_index, site.stream) for site in sites]
+        if cfg.collection.truncate_forward:
+            forward_ctx = truncated_forward(hooked.model, max(site.layer_index for site in sites))
+        else:
+            forward_ctx = nullcontext(hooked.model)
+        with torch.inference_mode(), multi_activation_collector(hooked.model, site_keys) as acts, forward_ctx as forward:
+            pbar = tqdm(desc=f"collect:{label}", total=tokens_target)
+            for input_ids, attention_mask, _ in batches:
+                if idx >= tokens_target:
+                    break
+                toks = input_ids.numpy().reshape(-1)
+                forward(input_ids=input_ids.to(device), attention_mask=attention_mask.to(device), use_cache=False)
+
+                n = min(toks.shape[0], tokens_target - idx)
+                for site in sites:
+                    writers[site].submit(acts[(site.layer_index, site.stream)].pop(), idx, n)
+                token_ids[idx : idx + n] = toks[:n]
+                idx += n
+                pbar.update(n)
+            pbar.close()
+        batches.close()
+        for site, writer in writers.items():
+            writer.close()
+            stores[site].finalize(idx)
+
+        elapsed = time.time() - t0
+        mb = (idx * d_model * 2) / (1024 * 1024)
+        metas: dict[Site, dict] = {}
+        for site in sites:
+            toks_path = site.out_dir / f"tokens_{label}.npy"
+            np.save(toks_path, token_ids[:idx])
+            meta = {
+                "label": label,
+                "tokens_collected": idx,
+                "d_model": d_model,
+                "acts_path": str(site.out_dir / f"acts_{label}.mmap"),
+                "tokens_path": str(toks_path),
+                "dtype": "float16",
+                "throughput_tokens_per_sec": idx / max(elapsed, 1e-6),
+                "producer_stall_sec": batches.stall_sec,
+                "producer_stall_frac": batches.stall_sec / max(elapsed, 1e-6),
+                "num_workers": cfg.collection.num_workers,
+                "sites_per_pass": len(sites),
+                "storage_mb": mb,
+                "model_load_sec": self.model_load_sec,
+                "model_name": cfg.model.model_name,
+                "model_hash": self.model_hash,
+                "layer_index": site.layer_index,
+                "activation_stream": site.stream,
+            }
+            with open(site.out_dir / f"meta_{label}.json", "w", encoding="utf-8") as f:
+                json.dump(meta, f, indent=2)
+            metas[site] = meta
+        print(
+            f"[{label}] tokens={idx} sites={len(sites)} throughput={idx / max(elapsed, 1e-6):.1f}/s "
+            f"producer_stall={batches.stall_sec:.2f}s storage={mb * len(sites):.1f}MB"
+        )
+        return metas
 
 
 def main() -> None:
     parser = argparse.ArgumentParser()
     parser.add_argument("--config", required=True)
+    parser.add_argument(
+        "--materialize",
+        action="store_true",
+        help="(Re)build the token shards under data.token_shards_dir and exit without running the model.",
+    )
+    parser.add_argument("--layers", default=None, help="Comma-separated layers to collect in one pass (default: model.layer_index).")
+    parser.add_argument("--streams", default=None, help="Comma-separated streams: mlp_output,residual (default: model.activation_stream).")
+    parser.add_argument(
+        "--output-template",
+        default=None,
+        help="Per-site output directory, formatted with {output_dir}, {layer} and {stream}.",
+    )
     args = parser.parse_args()
 
     cfg = load_config(args.config)
@@ -112,11 +301,25 @@ def main() -> None:
         cache_dir=cfg.data.cache_dir,
     )
 
-    meta_a = _collect_one_dataset(cfg, "A", spec_a, cfg.collection.tokens_a)
-    meta_b = _collect_one_dataset(cfg, "B", spec_b, cfg.collection.tokens_b)
+    if args.materialize:
+        if not cfg.data.token_shards_dir:
+            raise ValueError("--materialize requires data.token_shards_dir to be set in the config.")
+        tokenizer = load_tokenizer(cfg.model.model_name)
+        _materialize(cfg, "A", spec_a, tokenizer)
+        _materialize(cfg, "B", spec_b, tokenizer)
+        return
+
+    sites = _resolve_sites(cfg, args.layers, args.streams, args.output_template)
+    session = CollectionSession(cfg, sites)
+    datasets = {
+        "A": (spec_a, cfg.collection.tokens_a),
+        "B": (spec_b, cfg.collection.tokens_b),
+    }
+    metas = {label: session.collect(label, spec, target) for label, (spec, target) in datasets.items()}
 
-    with open(Path(cfg.collection.output_dir) / "meta_all.json", "w", encoding="utf-8") as f:
-        json.dump({"A": meta_a, "B": meta_b}, f, indent=2)
+    for site in sites:
+        with open(site.out_dir / "meta_all.json", "w", encoding="utf-8") as f:
+            json.dump({label: metas[label][site] for label in datasets}, f, indent=2)
 
 
 if __name__ == "__main__":
@@ -19,6 +19,9 @@ class DataConfig:
     text_field_b: str
     max_chars_per_example: int
     cache_dir: str
+    # When set, collection tokenizes each corpus once into `{token_shards_dir}/{label}`
+    # and reads token batches from those shards on every later run.
+    token_shards_dir: Optional[str] = None
 
 
 @dataclass
@@ -38,6 +41,12 @@ class CollectionConfig:
     tokens_b: int
     chunk_size: int
     output_dir: str
+    # Texts encoded per tokenizer call; fast tokenizers batch these natively.
+    tokenize_batch_size: int = 64
+    # Batches buffered ahead of the model when num_workers > 0.
+    prefetch_batches: int = 4
+    # Run only embeddings + blocks up to the deepest collected layer (no final norm / lm_head).
+    truncate_forward: bool = True
 
 
 @dataclass
@@ -54,6 +63,31 @@ class SAEConfig:
     recon_loss: str
     sparsity_mode: str = "relu_l1"
     topk: int = 64
+    # Rows resident per training buffer (bounds peak host RAM); shuffled in block_rows blocks.
+    chunk_rows: int = 65536
+    block_rows: int = 16384
+    # Steps between host syncs of the running train metrics (0 = only at epoch end).
+    log_every: int = 0
+    # Training precision: fp32, bf16 or fp16 (autocast; fp16 uses a loss scaler on CUDA).
+    precision: str = "fp32"
+    # torch.compile the forward + loss; falls back to eager if compilation fails.
+    compile: bool = False
+    # Resumable step checkpoints kept per label (older ones are deleted; <= 0 keeps all).
+    keep_checkpoints: int = 3
+    # A latent is dead after this many training steps without firing; dead_frac is logged per epoch.
+    dead_after_steps: int = 1000
+    # Steps between resampling dead latents toward high-loss inputs (0 = never resample).
+    resample_every: int = 0
+    # Renormalize decoder columns to unit norm after every optimizer step.
+    decoder_unit_norm: bool = False
+    # Pre-encoder bias init: "zero" (stays fixed at 0), "mean" or "geometric_median" (then trained).
+    b_pre_init: str = "zero"
+    b_pre_median_iters: int = 10
+    # Stop after this many epochs without progress (0 = run all epochs). An epoch makes progress
+    # if val_recon improves by more than early_stop_min_delta (relative), or val L0 (relative) or
+    # dead_frac (absolute) still moves by more than it. The best-val_recon weights become final.
+    early_stop_patience: int = 0
+    early_stop_min_delta: float = 0.001
 
 
 @dataclass
@@ -61,6 +95,8 @@ class InterpretConfig:
     top_features: int
     top_contexts: int
     context_window_tokens: int
+    # Top activations kept per feature by `src.feature_index` (stages needing more re-encode).
+    index_top_k: int = 64
 
 
 @dataclass
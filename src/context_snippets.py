@@ -0,0 +1,50 @@
+from __future__ import annotations
+
+from collections import OrderedDict
+from typing import Iterable
+
+import numpy as np
+
+
+class ContextSnippets:
+    """
+    Decoded text windows around token positions of a store, `window` tokens on each side.
+
+    Windows are memoized by (start, end) in an LRU of `max_entries`; `prefetch` decodes every
+    uncached window of a batch of positions in one deduplicated `batch_decode` call.
+    """
+
+    def __init__(self, tokenizer, token_ids: np.ndarray, window: int, max_entries: int = 65536):
+        self.tokenizer = tokenizer
+        self.token_ids = token_ids
+        self.window = window
+        self.max_entries = max_entries
+        self._cache: OrderedDict[tuple[int, int], str] = OrderedDict()
+
+    def span(self, i: int) -> tuple[int, int]:
+        lo = max(0, int(i) - self.window)
+        hi = min(len(self.token_ids), int(i) + self.window + 1)
+        return lo, hi
+
+    def _put(self, key: tuple[int, int], text: str) -> None:
+        self._cache[key] = text
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.max_entries:
+            self._cache.popitem(last=False)
+
+    def prefetch(self, positions: Iterable[int]) -> None:
+        missing = list(dict.fromkeys(s for s in map(self.span, positions) if s not in self._cache))
+        if not missing:
+            return
+        texts = self.tokenizer.batch_decode([self.token_ids[lo:hi] for lo, hi in missing], skip_special_tokens=True)
+        for key, text in zip(missing, texts):
+            self._put(key, text)
+
+    def __getitem__(self, i: int) -> str:
+        key = self.span(i)
+        text = self._cache.get(key)
+        if text is None:
+            lo, hi = key
+            text = self.tokenizer.decode(self.token_ids[lo:hi], skip_special_tokens=True)
+        self._put(key, text)
+        return text
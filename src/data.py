@@ -1,9 +1,18 @@
 from __future__ import annotations
 
+import bisect
+import json
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
-from itertools import islice
+from itertools import chain, islice
+from pathlib import Path
 from typing import Generator, Iterable
 
+import numpy as np
 import requests
 
 
@@ -20,6 +29,9 @@ CODE_URLS = [
     "https://raw.githubusercontent.com/numpy/numpy/main/numpy/core/fromnumeric.py",
 ]
 
+TOKEN_SHARD_DTYPE = np.uint32
+DEFAULT_SHARD_TOKENS = 1 << 24
+
 
 @dataclass
 class TextStreamSpec:
@@ -41,15 +53,13 @@ def _chunk_nonempty(text: str) -> list[str]:
     return [c.strip() for c in text.split("\n\n") if c.strip()]
 
 
-def load_text_stream(spec: TextStreamSpec) -> Iterable[str]:
+def load_corpus_chunks(spec: TextStreamSpec) -> list[str]:
+    """Download the corpus once and return its non-empty chunks in stream order."""
     name = spec.name.lower()
 
     if "wiki" in name:
         text = _download_text(WIKI_URL)
-        chunks = [ln.strip() for ln in text.splitlines() if ln.strip()]
-        while True:
-            for c in chunks:
-                yield c[: spec.max_chars_per_example]
+        return [ln.strip() for ln in text.splitlines() if ln.strip()]
 
     if "code" in name or "github" in name:
         corpora: list[str] = []
@@ -62,41 +72,347 @@ def load_text_stream(spec: TextStreamSpec) -> Iterable[str]:
 
         if not corpora:
             raise RuntimeError("No code sources could be downloaded.")
-
-        while True:
-            for c in corpora:
-                yield c[: spec.max_chars_per_example]
+        return corpora
 
     raise ValueError(f"Unsupported dataset name: {spec.name}. Use wiki-like for A and code-like for B.")
 
 
+def load_text_stream(spec: TextStreamSpec) -> Iterable[str]:
+    chunks = load_corpus_chunks(spec)
+    while True:
+        for c in chunks:
+            yield c[: spec.max_chars_per_example]
+
+
+def encode_texts(tokenizer, texts: list[str]) -> list[list[int]]:
+    """Encode a list of texts in one tokenizer call (fast tokenizers batch this natively)."""
+    if len(texts) == 1:
+        return [tokenizer.encode(texts[0], add_special_tokens=False)]
+    return tokenizer(texts, add_special_tokens=False, return_attention_mask=False)["input_ids"]
+
+
+def _grouped(texts: Iterable[str], group_size: int) -> Generator[list[str], None, None]:
+    it = iter(texts)
+    while True:
+        group = list(islice(it, max(group_size, 1)))
+        if not group:
+            return
+        yield group
+
+
+def _encoded_groups(
+    texts: Iterable[str],
+    tokenizer,
+    group_size: int,
+    num_workers: int = 0,
+) -> Generator[tuple[list[str], list[list[int]]], None, None]:
+    """
+    Yield (texts, ids) per group of `group_size` texts, in input order.
+
+    With num_workers > 1, groups are encoded on a thread pool (fast tokenizers release
+    the GIL) with at most 2 * num_workers groups in flight.
+    """
+    groups = _grouped(texts, group_size)
+    if num_workers <= 1:
+        for group in groups:
+            yield group, encode_texts(tokenizer, group)
+        return
+
+    with ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix="tokenize") as pool:
+        pending: deque = deque()
+        for group in groups:
+            pending.append((group, pool.submit(encode_texts, tokenizer, group)))
+            if len(pending) >= 2 * num_workers:
+                group_done, fut = pending.popleft()
+                yield group_done, fut.result()
+        while pending:
+            group_done, fut = pending.popleft()
+            yield group_done, fut.result()
+
+
+def materialize_token_shards(
+    spec: TextStreamSpec,
+    tokenizer,
+    out_dir: str | Path,
+    shard_tokens: int = DEFAULT_SHARD_TOKENS,
+    encode_batch_size: int = 64,
+) -> dict:
+    """
+    Tokenize one pass over the corpus and write it to disk as flat uint32 shards.
+
+    Layout of `out_dir`:
+    - tokens_00000.bin, tokens_00001.bin, ...: concatenated token ids, `shard_tokens` per file
+    - offsets.npy: int64 start offset of every text in the global token stream (plus the end)
+    - meta.json: shard sizes and the dataset/tokenizer the shards were built from
+    """
+    out = Path(out_dir)
+    out.mkdir(parents=True, exist_ok=True)
+    for stale in out.glob("tokens_*.bin"):
+        stale.unlink()
+
+    offsets = [0]
+    shards: list[dict] = []
+    fh = None
+    shard_fill = 0
+    total = 0
+
+    def open_shard():
+        path = out / f"tokens_{len(shards):05d}.bin"
+        shards.append({"file": path.name, "n_tokens": 0})
+        return open(path, "wb")
+
+    texts = (c[: spec.max_chars_per_example] for c in load_corpus_chunks(spec))
+    try:
+        for ids in chain.from_iterable(encode_texts(tokenizer, g) for g in _grouped(texts, encode_batch_size)):
+            if not ids:
+                continue
+            arr = np.asarray(ids, dtype=TOKEN_SHARD_DTYPE)
+            pos = 0
+            while pos < len(arr):
+                if fh is None or shard_fill >= shard_tokens:
+                    if fh is not None:
+                        fh.close()
+                    fh = open_shard()
+                    shard_fill = 0
+                take = min(len(arr) - pos, shard_tokens - shard_fill)
+                arr[pos : pos + take].tofile(fh)
+                shards[-1]["n_tokens"] += take
+                shard_fill += take
+                pos += take
+            total += len(arr)
+            offsets.append(total)
+    finally:
+        if fh is not None:
+            fh.close()
+
+    if total == 0:
+        raise RuntimeError(f"Corpus {spec.name} produced no tokens.")
+
+    np.save(out / "offsets.npy", np.asarray(offsets, dtype=np.int64))
+    meta = {
+        "dataset_name": spec.name,
+        "max_chars_per_example": spec.max_chars_per_example,
+        "tokenizer": getattr(tokenizer, "name_or_path", ""),
+        "dtype": np.dtype(TOKEN_SHARD_DTYPE).name,
+        "n_tokens": total,
+        "n_texts": len(offsets) - 1,
+        "shards": shards,
+    }
+    with open(out / "meta.json", "w", encoding="utf-8") as f:
+        json.dump(meta, f, indent=2)
+    return meta
+
+
+class TokenShards:
+    """Read-only, memory-mapped view over shards written by `materialize_token_shards`."""
+
+    def __init__(self, root: str | Path):
+        self.root = Path(root)
+        with open(self.root / "meta.json", "r", encoding="utf-8") as f:
+            self.meta = json.load(f)
+        dtype = np.dtype(self.meta["dtype"])
+        self._shards = [
+            np.memmap(self.root / s["file"], mode="r", dtype=dtype, shape=(int(s["n_tokens"]),))
+            for s in self.meta["shards"]
+        ]
+        self._starts = np.cumsum([0] + [len(s) for s in self._shards]).tolist()
+
+    def __len__(self) -> int:
+        return self._starts[-1]
+
+    @property
+    def offsets(self) -> np.ndarray:
+        return np.load(self.root / "offsets.npy", mmap_mode="r")
+
+    def check_matches(self, spec: TextStreamSpec, tokenizer) -> None:
+        expected = {
+            "dataset_name": spec.name,
+            "max_chars_per_example": spec.max_chars_per_example,
+            "tokenizer": getattr(tokenizer, "name_or_path", ""),
+        }
+        for key, value in expected.items():
+            if self.meta.get(key) != value:
+                raise ValueError(
+                    f"Token shards at {self.root} were built with {key}={self.meta.get(key)!r}, "
+                    f"expected {value!r}. Re-run collection with --materialize to rebuild them."
+                )
+
+    def read(self, start: int, n: int) -> np.ndarray:
+        """Return `n` token ids starting at global position `start`, wrapping around the corpus."""
+        total = len(self)
+        pieces = []
+        pos = start % total
+        need = n
+        while need > 0:
+            s = bisect.bisect_right(self._starts, pos) - 1
+            local = pos - self._starts[s]
+            take = min(need, len(self._shards[s]) - local)
+            pieces.append(self._shards[s][local : local + take])
+            need -= take
+            pos = (pos + take) % total
+        return np.concatenate(pieces).astype(np.int64, copy=False)
+
+
+class _TokenBuffer:
+    """
+    Preallocated int64 token buffer: ids are appended at the tail and fixed-size windows
+    popped from the head. When the tail reaches the end, the (short) live region is moved
+    back to the front instead of wrapping, so every popped window is one contiguous slice.
+    """
+
+    def __init__(self, capacity: int):
+        self._buf = np.empty((capacity,), dtype=np.int64)
+        self._head = 0
+        self._tail = 0
+
+    def __len__(self) -> int:
+        return self._tail - self._head
+
+    def push(self, ids: np.ndarray) -> None:
+        n = len(ids)
+        if self._tail + n > len(self._buf):
+            live = len(self)
+            if live + n > len(self._buf):
+                grown = np.empty((max(2 * len(self._buf), live + n),), dtype=np.int64)
+                grown[:live] = self._buf[self._head : self._tail]
+                self._buf = grown
+            else:
+                self._buf[:live] = self._buf[self._head : self._tail]
+            self._head = 0
+            self._tail = live
+        self._buf[self._tail : self._tail + n] = ids
+        self._tail += n
+
+    def pop(self, n: int) -> np.ndarray:
+        out = self._buf[self._head : self._head + n].copy()
+        self._head += n
+        return out
+
+
 def token_batches(
     texts: Iterable[str],
     tokenizer,
     seq_len: int,
     batch_size: int,
     total_tokens_target: int,
+    encode_batch_size: int = 64,
+    num_workers: int = 0,
 ) -> Generator[tuple, None, None]:
-    """Yield (input_ids, attention_mask, token_texts) as fixed-size batches."""
-    buffer: list[int] = []
-    token_texts: list[str] = []
+    """
+    Yield (input_ids, attention_mask, token_texts) as fixed-size batches.
+
+    Texts are encoded `encode_batch_size` at a time (on `num_workers` threads when > 1) and
+    packed into a preallocated NumPy buffer, so batches are sliced out without building
+    Python lists of ids.
+    """
+    import torch
+
+    n = seq_len * batch_size
+    buffer = _TokenBuffer(2 * n)
+    token_texts: deque[str] = deque(maxlen=batch_size)
     produced = 0
 
-    for txt in texts:
-        ids = tokenizer.encode(txt, add_special_tokens=False)
-        if not ids:
+    for group, encoded in _encoded_groups(texts, tokenizer, encode_batch_size, num_workers):
+        total = sum(len(ids) for ids in encoded)
+        if total == 0:
             continue
-        buffer.extend(ids)
-        token_texts.append(txt)
-
-        while len(buffer) >= seq_len * batch_size and produced < total_tokens_target:
-            chunk = list(islice(buffer, 0, seq_len * batch_size))
-            del buffer[: seq_len * batch_size]
-            import torch
+        buffer.push(np.fromiter(chain.from_iterable(encoded), dtype=np.int64, count=total))
+        token_texts.extend(txt for txt, ids in zip(group, encoded) if ids)
 
-            x = torch.tensor(chunk, dtype=torch.long).reshape(batch_size, seq_len)
+        while len(buffer) >= n and produced < total_tokens_target:
+            x = torch.from_numpy(buffer.pop(n)).reshape(batch_size, seq_len)
             attn = torch.ones_like(x)
             produced += x.numel()
-            yield x, attn, token_texts[-batch_size:]
+            yield x, attn, list(token_texts)
             if produced >= total_tokens_target:
                 return
+
+
+def shard_token_batches(
+    shards: TokenShards,
+    seq_len: int,
+    batch_size: int,
+    total_tokens_target: int,
+) -> Generator[tuple, None, None]:
+    """
+    Same contract as `token_batches`, but reads pre-tokenized shards through the memory map.
+
+    token_texts is always empty: the raw text is not kept alongside the shards.
+    """
+    import torch
+
+    n = seq_len * batch_size
+    produced = 0
+    while produced < total_tokens_target:
+        chunk = shards.read(produced, n)
+        x = torch.from_numpy(chunk).reshape(batch_size, seq_len)
+        attn = torch.ones_like(x)
+        produced += x.numel()
+        yield x, attn, []
+
+
+class BatchPrefetcher:
+    """
+    Iterate `batches` on a background producer thread through a bounded queue of `depth` items.
+
+    depth == 0 iterates inline. Either way, `stall_sec` accumulates the time the consumer
+    spent waiting for the next batch.
+    """
+
+    _DONE = object()
+
+    def __init__(self, batches: Iterable, depth: int = 0):
+        self.stall_sec = 0.0
+        self._depth = depth
+        self._it = iter(batches)
+        self._error: BaseException | None = None
+        self._stop = threading.Event()
+        self._finished = False
+        self._thread = None
+        if depth > 0:
+            self._queue: queue.Queue = queue.Queue(maxsize=depth)
+            self._thread = threading.Thread(target=self._produce, name="batch-producer", daemon=True)
+            self._thread.start()
+
+    def _put(self, item) -> bool:
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _produce(self) -> None:
+        try:
+            for item in self._it:
+                if not self._put(item):
+                    return
+        except BaseException as e:  # surfaced on the consumer thread
+            self._error = e
+        self._put(self._DONE)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        t0 = time.perf_counter()
+        try:
+            if self._thread is None:
+                return next(self._it)
+            if self._finished:
+                raise StopIteration
+            item = self._queue.get()
+            if item is self._DONE:
+                self._finished = True
+                if self._error is not None:
+                    raise self._error
+                raise StopIteration
+            return item
+        finally:
+            self.stall_sec += time.perf_counter() - t0
+
+    def close(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
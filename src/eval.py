@@ -8,45 +8,70 @@ import numpy as np
 import pandas as pd
 import torch
 
+from .activation_store import ActivationStore, open_label_store
 from .config import load_config
+from .feature_index import open_index
 from .sae import SparseAutoencoder
 from .utils import get_device, set_seed
 
 
-def load_acts(cfg, label: str):
-    with open(Path(cfg.collection.output_dir) / f"meta_{label}.json", "r", encoding="utf-8") as f:
-        meta = json.load(f)
-    n = int(meta["tokens_collected"])
-    d_model = int(meta["d_model"])
-    mmap = np.memmap(meta["acts_path"], mode="r", dtype=np.float16, shape=(cfg.collection.__dict__[f'tokens_{label.lower()}'], d_model))
-    return torch.from_numpy(np.array(mmap[:n], dtype=np.float32)), d_model
+def eval_pair(model, store: ActivationStore, device: torch.device, chunk_rows: int):
+    """Reconstruction/sparsity metrics over the whole store, streamed in `chunk_rows` chunks."""
+    d_model = store.d_model
+    n = 0
+    sq_err = 0.0
+    # running sums live on the CPU in float64 (MPS has no float64)
+    col_sum = torch.zeros(d_model, dtype=torch.float64)
+    col_sumsq = torch.zeros(d_model, dtype=torch.float64)
+    l0_chunks = []
+    l1_sum = 0.0
+    fire = None
+    mag = None
 
-
-def eval_pair(model, x: torch.Tensor, device: torch.device):
     with torch.no_grad():
-        xb = x.to(device)
-        recon, h = model(xb)
-        err = recon - xb
-        mse = float((err.pow(2).mean()).item())
-        var = float(((xb - xb.mean(dim=0)).pow(2).mean()).item())
-        r2 = float(1.0 - mse / max(var, 1e-8))
-
-        l0 = (h > 0).sum(dim=1).float()
-        l1 = h.abs().sum(dim=1)
-        freq = (h > 0).float().mean(dim=0)
-        mag = h.mean(dim=0)
+        for _, chunk in store.iter_chunks(chunk_rows):
+            xb = torch.from_numpy(np.array(chunk)).to(device).float()
+            recon, h = model(xb)
+            sq_err += float((recon - xb).pow(2).sum().item())
+            col_sum += xb.sum(dim=0).cpu().double()
+            col_sumsq += xb.pow(2).sum(dim=0).cpu().double()
+
+            l0 = (h > 0).sum(dim=1).float()
+            l0_chunks.append(l0.cpu())
+            l1_sum += float(h.abs().sum().item())
+            chunk_fire = (h > 0).sum(dim=0).cpu().double()
+            chunk_mag = h.sum(dim=0).cpu().double()
+            fire = chunk_fire if fire is None else fire + chunk_fire
+            mag = chunk_mag if mag is None else mag + chunk_mag
+            n += xb.shape[0]
+
+    mse = sq_err / max(n * d_model, 1)
+    mean = col_sum / max(n, 1)
+    var = float((col_sumsq / max(n, 1) - mean.pow(2)).mean().item())
+    r2 = float(1.0 - mse / max(var, 1e-8))
+    l0_values = torch.cat(l0_chunks).numpy()
 
     return {
         "mse": mse,
         "r2": r2,
-        "avg_l0": float(l0.mean().item()),
-        "avg_l1": float(l1.mean().item()),
-        "l0_values": l0.cpu().numpy(),
-        "freq": freq.cpu().numpy(),
-        "mag": mag.cpu().numpy(),
+        "avg_l0": float(l0_values.mean()),
+        "avg_l1": l1_sum / max(n, 1),
+        "l0_values": l0_values,
+        "freq": (fire / max(n, 1)).float().numpy(),
+        "mag": (mag / max(n, 1)).float().numpy(),
     }
 
 
+def _mean_code(model, store: ActivationStore, device: torch.device, chunk_rows: int) -> np.ndarray:
+    total = None
+    with torch.no_grad():
+        for _, chunk in store.iter_chunks(chunk_rows):
+            h = model.encode_inference(torch.from_numpy(np.array(chunk)).to(device).float(), reuse=True)
+            part = h.sum(dim=0).cpu().double()
+            total = part if total is None else total + part
+    return (total / max(len(store), 1)).float().numpy()
+
+
 def main() -> None:
     parser = argparse.ArgumentParser()
     parser.add_argument("--config", required=True)
@@ -56,8 +81,10 @@ def main() -> None:
     set_seed(cfg.seed)
     device = get_device(cfg.device_preference)
 
-    xA, d_model = load_acts(cfg, "A")
-    xB, _ = load_acts(cfg, "B")
+    storeA, _ = open_label_store(cfg.collection.output_dir, "A", cfg)
+    storeB, _ = open_label_store(cfg.collection.output_dir, "B", cfg)
+    d_model = storeA.d_model
+    chunk_rows = cfg.collection.chunk_size
 
     rows = []
     all_results = {}
@@ -73,8 +100,8 @@ def main() -> None:
         model.load_state_dict(torch.load(ckpt, map_location=device))
         model.eval()
 
-        for eval_label, x in [("A", xA), ("B", xB)]:
-            metrics = eval_pair(model, x, device)
+        for eval_label, store in [("A", storeA), ("B", storeB)]:
+            metrics = eval_pair(model, store, device, chunk_rows)
             key = f"train{train_label}_eval{eval_label}"
             all_results[key] = {
                 k: v for k, v in metrics.items() if k not in {"l0_values", "freq", "mag"}
@@ -98,18 +125,19 @@ def main() -> None:
             freq_mag_df.to_csv(Path(cfg.outputs.tables_dir) / f"feature_freq_mag_train{train_label}_eval{eval_label}.csv", index=False)
 
     # selectivity proxy using model A features
-    modelA = SparseAutoencoder(
-        d_model=d_model,
-        d_sae=cfg.sae.d_sae,
-        sparsity_mode=cfg.sae.sparsity_mode,
-        topk=cfg.sae.topk,
-    ).to(device)
-    modelA.load_state_dict(torch.load(Path(cfg.outputs.checkpoints_dir) / "sae_A.pt", map_location=device))
-    modelA.eval()
-    with torch.no_grad():
-        hA = modelA.encode(xA.to(device)).cpu().numpy()
-        hB = modelA.encode(xB.to(device)).cpu().numpy()
-    sel = hA.mean(axis=0) - hB.mean(axis=0)
+    indexA, indexB = open_index(cfg, "A", "A"), open_index(cfg, "A", "B")
+    if indexA is not None and indexB is not None:
+        sel = indexA.mean.astype(np.float32) - indexB.mean.astype(np.float32)
+    else:
+        modelA = SparseAutoencoder(
+            d_model=d_model,
+            d_sae=cfg.sae.d_sae,
+            sparsity_mode=cfg.sae.sparsity_mode,
+            topk=cfg.sae.topk,
+        ).to(device)
+        modelA.load_state_dict(torch.load(Path(cfg.outputs.checkpoints_dir) / "sae_A.pt", map_location=device))
+        modelA.eval()
+        sel = _mean_code(modelA, storeA, device, chunk_rows) - _mean_code(modelA, storeB, device, chunk_rows)
     pd.DataFrame({"feature": np.arange(len(sel)), "selectivity_A_minus_B": sel}).to_csv(
         Path(cfg.outputs.tables_dir) / "feature_selectivity_AminusB.csv", index=False
     )
@@ -26,9 +26,9 @@ def intervention_hook_factory(sae: SparseAutoencoder, feature_idx: int, alpha: f
         x = out
         orig_dtype = x.dtype
         with torch.no_grad():
-            h = sae.encode(x.float())
+            h = sae.encode_inference(x.float())
             h[..., feature_idx] = h[..., feature_idx] * alpha
-            recon = sae.decoder(h)
+            recon = sae.decode(h)
         return recon.to(orig_dtype)
 
     return hook
@@ -80,7 +80,7 @@ def collect_feature_activation(model, tokenizer, sae: SparseAutoencoder, layer_i
     def probe_hook(_module, _inp, out):
         x = out.float()
         with torch.no_grad():
-            h = sae.encode(x)
+            h = sae.encode_inference(x)
         # mean + max over batch/seq for this feature
         feat = h[..., feature_idx]
         collected["mean"] = float(feat.mean().item())
@@ -63,7 +63,7 @@ def gated_residual_hook_factory(sae: SparseAutoencoder, feature_idx: int, alpha:
         dt = x.dtype
         with torch.no_grad():
             xf = x.float()
-            h0 = sae.encode(xf)
+            h0 = sae.encode_inference(xf)
             h1 = h0.clone()
 
             feat = h0[..., feature_idx]
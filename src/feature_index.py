@@ -0,0 +1,267 @@
+from __future__ import annotations
+
+import argparse
+import hashlib
+import json
+import os
+import shutil
+from pathlib import Path
+from typing import Any
+
+import numpy as np
+import torch
+
+from .activation_store import ActivationStore, open_label_store
+from .config import load_config
+from .feature_stats import encode_chunks, merge_topk
+from .sae import SparseAutoencoder
+from .utils import get_device, set_seed
+
+INDEX_VERSION = 1
+
+
+class FeatureIndex:
+    """
+    SAE codes of one activation store under one checkpoint, encoded once and kept on disk.
+
+    Directory layout: meta.json; the nonzero codes as CSR (indptr.npy [n_tokens + 1] plus raw
+    indices.bin / values.bin of length nnz, memory-mapped on open); per-feature freq/mean/max
+    (.npy, float64); and the `top_k` largest activations of every feature as top_values.npy /
+    top_tokens.npy, each [top_k, d_sae] and sorted largest first.
+    """
+
+    def __init__(self, path: Path, meta: dict[str, Any]):
+        self.path = path
+        self.meta = meta
+        self.indptr = np.load(path / "indptr.npy")
+        nnz = int(meta["nnz"])
+        self.indices = np.memmap(path / "indices.bin", mode="r", dtype=np.dtype(meta["indices_dtype"]), shape=(nnz,))
+        self.values = np.memmap(path / "values.bin", mode="r", dtype=np.float32, shape=(nnz,))
+        self.freq = np.load(path / "freq.npy")
+        self.mean = np.load(path / "mean.npy")
+        self.max = np.load(path / "max.npy")
+        self.top_values = np.load(path / "top_values.npy", mmap_mode="r")
+        self.top_tokens = np.load(path / "top_tokens.npy", mmap_mode="r")
+
+    @classmethod
+    def open(cls, path: str | Path) -> "FeatureIndex":
+        path = Path(path)
+        with open(path / "meta.json", "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        return cls(path, meta)
+
+    @property
+    def n_tokens(self) -> int:
+        return int(self.meta["n_tokens"])
+
+    @property
+    def d_sae(self) -> int:
+        return int(self.meta["d_sae"])
+
+    @property
+    def top_k(self) -> int:
+        return int(self.meta["top_k"])
+
+    def stats(self) -> dict[str, np.ndarray]:
+        """Same keys as `feature_stats.feature_stats`."""
+        return {"freq": self.freq, "mean": self.mean, "max": self.max}
+
+    def top_activations(self, features: np.ndarray, k: int) -> dict[int, list[tuple[float, int]]]:
+        """Same result as `feature_stats.top_activations`, for k <= top_k."""
+        if k > self.top_k and self.top_k < self.n_tokens:
+            raise ValueError(f"Index keeps {self.top_k} activations per feature; {k} requested.")
+        feats = [int(f) for f in features]
+        vals = np.asarray(self.top_values[:k, feats]).T.tolist()
+        idx = np.asarray(self.top_tokens[:k, feats]).T.tolist()
+        return {f: list(zip(v, i)) for f, v, i in zip(feats, vals, idx)}
+
+    def rows(self, idx: np.ndarray) -> np.ndarray:
+        """Dense float32 codes [len(idx), d_sae] for token rows `idx`, in the given order."""
+        idx = np.asarray(idx, dtype=np.int64)
+        out = np.zeros((len(idx), self.d_sae), dtype=np.float32)
+        starts = self.indptr[idx]
+        counts = self.indptr[idx + 1] - starts
+        total = int(counts.sum())
+        if total == 0:
+            return out
+        offsets = np.cumsum(counts) - counts
+        pos = np.arange(total) - np.repeat(offsets, counts) + np.repeat(starts, counts)
+        out[np.repeat(np.arange(len(idx)), counts), self.indices[pos]] = self.values[pos]
+        return out
+
+
+def checkpoint_key(ckpt: str | Path, sparsity_mode: str, topk: int) -> str:
+    """Short hash of the checkpoint bytes plus the settings that change its codes (build time only)."""
+    h = hashlib.sha256()
+    with open(ckpt, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    h.update(f"\n{sparsity_mode}\n{topk}\n{INDEX_VERSION}".encode("utf-8"))
+    return h.hexdigest()[:16]
+
+
+def _checkpoint_info(ckpt: Path, sparsity_mode: str, topk: int) -> dict[str, Any]:
+    st = ckpt.stat()
+    return {
+        "path": str(ckpt),
+        "size": st.st_size,
+        "mtime_ns": st.st_mtime_ns,
+        "sparsity_mode": sparsity_mode,
+        "topk": topk,
+        "version": INDEX_VERSION,
+    }
+
+
+def _store_info(store: ActivationStore) -> dict[str, Any]:
+    return {"path": str(store.path), "n_tokens": len(store), "mtime_ns": store.path.stat().st_mtime_ns}
+
+
+def index_path(cfg, ckpt_label: str, store_label: str, key: str) -> Path:
+    """Where the index of store `store_label` under checkpoint sae_{ckpt_label}.pt (content `key`) lives."""
+    return Path(cfg.outputs.checkpoints_dir) / "feature_index" / f"sae_{ckpt_label}_{key}" / f"acts_{store_label}"
+
+
+def _read_meta(path: Path) -> dict[str, Any] | None:
+    try:
+        with open(path / "meta.json", "r", encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def open_index(cfg, ckpt_label: str, store_label: str, top_k: int = 0) -> FeatureIndex | None:
+    """
+    The index for (checkpoint, store) if one was built from the current checkpoint and store
+    and keeps at least `top_k` activations per feature; otherwise None (callers re-encode).
+
+    The checkpoint is matched by path, size and mtime as recorded at build time, so opening an
+    index never reads the checkpoint itself.
+    """
+    ckpt = Path(cfg.outputs.checkpoints_dir) / f"sae_{ckpt_label}.pt"
+    if not ckpt.exists():
+        return None
+    info = _checkpoint_info(ckpt, cfg.sae.sparsity_mode, cfg.sae.topk)
+    store, _ = open_label_store(cfg.collection.output_dir, store_label, cfg)
+    for path in sorted((Path(cfg.outputs.checkpoints_dir) / "feature_index").glob(f"sae_{ckpt_label}_*/acts_{store_label}")):
+        meta = _read_meta(path)
+        if meta is None or meta.get("checkpoint") != info or meta["store"] != _store_info(store):
+            continue
+        if meta["top_k"] < min(top_k, meta["n_tokens"]):
+            return None
+        print(f"Using feature index {path}")
+        return FeatureIndex(path, meta)
+    return None
+
+
+def build_index(sae, store: ActivationStore, device: torch.device, chunk_rows: int, top_k: int, out: Path, **info: Any) -> None:
+    """Encode `store` once, streaming CSR codes to disk; the directory is renamed into place at the end."""
+    d_sae = sae.encoder.out_features
+    indices_dtype = np.dtype(np.uint16 if d_sae <= 1 << 16 else np.int32)
+    tmp = out.with_name(out.name + ".tmp")
+    shutil.rmtree(tmp, ignore_errors=True)
+    tmp.mkdir(parents=True)
+
+    # running sums live on the CPU in float64 (MPS has no float64)
+    fire = torch.zeros(d_sae, dtype=torch.float64)
+    total = torch.zeros(d_sae, dtype=torch.float64)
+    peak = torch.full((d_sae,), -float("inf"), dtype=torch.float64)
+    best_vals = torch.empty(0, d_sae, device=device)
+    best_idx = torch.empty(0, d_sae, dtype=torch.long, device=device)
+    row_nnz = []
+    with open(tmp / "indices.bin", "wb") as f_idx, open(tmp / "values.bin", "wb") as f_val:
+        for lo, h in encode_chunks(sae, store, device, chunk_rows):
+            h = h.float()
+            fire += (h > 0).sum(dim=0).cpu().double()
+            total += h.sum(dim=0).cpu().double()
+            peak = torch.maximum(peak, h.max(dim=0).values.cpu().double())
+            best_vals, best_idx = merge_topk(best_vals, best_idx, h, lo, top_k)
+
+            h = h.cpu()
+            nz = h != 0
+            row_nnz.append(nz.sum(dim=1).numpy())
+            rows, cols = nz.nonzero(as_tuple=True)
+            f_idx.write(cols.numpy().astype(indices_dtype).tobytes())
+            f_val.write(h[rows, cols].numpy().tobytes())
+
+    n = len(store)
+    indptr = np.zeros(n + 1, dtype=np.int64)
+    if row_nnz:
+        np.cumsum(np.concatenate(row_nnz), out=indptr[1:])
+    np.save(tmp / "indptr.npy", indptr)
+    np.save(tmp / "freq.npy", (fire / max(n, 1)).numpy())
+    np.save(tmp / "mean.npy", (total / max(n, 1)).numpy())
+    np.save(tmp / "max.npy", peak.numpy())
+    np.save(tmp / "top_values.npy", best_vals.cpu().numpy())
+    np.save(tmp / "top_tokens.npy", best_idx.cpu().numpy())
+    meta = {
+        "version": INDEX_VERSION,
+        "n_tokens": n,
+        "d_sae": d_sae,
+        "nnz": int(indptr[-1]),
+        "indices_dtype": indices_dtype.name,
+        "top_k": int(best_vals.shape[0]),
+        "store": _store_info(store),
+        **info,
+    }
+    with open(tmp / "meta.json", "w", encoding="utf-8") as f:
+        json.dump(meta, f, indent=2)
+
+    shutil.rmtree(out, ignore_errors=True)
+    os.replace(tmp, out)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Encode each activation store once per SAE checkpoint and index the codes.")
+    parser.add_argument("--config", required=True)
+    parser.add_argument("--labels", default="A,B", help="Checkpoints to index; each is indexed over both stores.")
+    parser.add_argument("--force", action="store_true", help="Rebuild indexes that are already current.")
+    args = parser.parse_args()
+
+    cfg = load_config(args.config)
+    set_seed(cfg.seed)
+    device = get_device(cfg.device_preference)
+    top_k = cfg.interpret.index_top_k
+
+    for ckpt_label in [x.strip() for x in args.labels.split(",") if x.strip()]:
+        ckpt = Path(cfg.outputs.checkpoints_dir) / f"sae_{ckpt_label}.pt"
+        info = _checkpoint_info(ckpt, cfg.sae.sparsity_mode, cfg.sae.topk)
+        key = None
+        sae = None
+        keep = set()
+        for store_label in ["A", "B"]:
+            current = None if args.force else open_index(cfg, ckpt_label, store_label, top_k)
+            if current is not None:
+                keep.add(current.path.parent)
+                continue
+            if key is None:
+                key = checkpoint_key(ckpt, cfg.sae.sparsity_mode, cfg.sae.topk)
+            store, _ = open_label_store(cfg.collection.output_dir, store_label, cfg)
+            out = index_path(cfg, ckpt_label, store_label, key)
+            keep.add(out.parent)
+            meta = _read_meta(out)
+            if not args.force and meta is not None and meta["store"] == _store_info(store) and meta["top_k"] >= min(top_k, len(store)):
+                # same checkpoint bytes under a new mtime (touched or copied): only the recorded stat is stale
+                meta["checkpoint"] = info
+                with open(out / "meta.json", "w", encoding="utf-8") as f:
+                    json.dump(meta, f, indent=2)
+                print(f"Refreshed {out}")
+                continue
+            if sae is None:
+                sae = SparseAutoencoder(
+                    d_model=store.d_model,
+                    d_sae=cfg.sae.d_sae,
+                    sparsity_mode=cfg.sae.sparsity_mode,
+                    topk=cfg.sae.topk,
+                ).to(device)
+                sae.load_state_dict(torch.load(ckpt, map_location=device))
+                sae.eval()
+            build_index(sae, store, device, cfg.collection.chunk_size, top_k, out, checkpoint=info, checkpoint_key=key)
+            print(f"Wrote {out}")
+        # indexes of earlier versions of this checkpoint are stale
+        for old in (Path(cfg.outputs.checkpoints_dir) / "feature_index").glob(f"sae_{ckpt_label}_*"):
+            if old not in keep:
+                shutil.rmtree(old, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
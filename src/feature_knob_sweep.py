@@ -8,24 +8,17 @@ import numpy as np
 import pandas as pd
 import torch
 
+from .activation_store import open_label_store
 from .config import load_config
+from .feature_index import open_index
 from .sae import SparseAutoencoder
 from .utils import get_device, set_seed
 
 
-def load_acts(cfg, label: str):
-    with open(Path(cfg.collection.output_dir) / f"meta_{label}.json", "r", encoding="utf-8") as f:
-        meta = json.load(f)
-    n = int(meta["tokens_collected"])
-    d_model = int(meta["d_model"])
-    mmap = np.memmap(
-        meta["acts_path"],
-        mode="r",
-        dtype=np.float16,
-        shape=(cfg.collection.__dict__[f"tokens_{label.lower()}"], d_model),
-    )
-    x = np.array(mmap[:n], dtype=np.float32)
-    return torch.from_numpy(x), d_model
+def load_acts(cfg, label: str, max_tokens: int | None = None):
+    store, _ = open_label_store(cfg.collection.output_dir, label, cfg)
+    x = np.array(store.array[:max_tokens], dtype=np.float32)
+    return torch.from_numpy(x), store.d_model
 
 
 def parse_alphas(raw: str) -> list[float]:
@@ -94,9 +87,8 @@ def main() -> None:
     cfg = load_config(args.config)
     set_seed(cfg.seed)
 
-    x_all, d_model = load_acts(cfg, args.label)
-    n = min(len(x_all), args.max_tokens)
-    x = x_all[:n]
+    x, d_model = load_acts(cfg, args.label, max_tokens=args.max_tokens)
+    n = len(x)
 
     device = get_device(cfg.device_preference)
     sae = SparseAutoencoder(
@@ -124,9 +116,28 @@ def main() -> None:
 
     xb = x.to(device)
 
+    # Only the swept features' columns of the codes are kept: scaling feature f by alpha moves the
+    # reconstruction by (alpha - 1) * h[:, f] * W_dec[:, f], so no [n, d_sae] copy is needed.
+    feats = list(dict.fromkeys(selected + controls))
+    col_of = {f: i for i, f in enumerate(feats)}
+    cols = torch.as_tensor(feats, dtype=torch.long, device=device)
+    index = open_index(cfg, args.label, args.label)
     with torch.no_grad():
-        h_base = sae.encode(xb)
-        recon_base = sae.decoder(h_base)
+        if index is not None:
+            # decode the CSR codes a chunk of rows at a time
+            recon_base = torch.empty_like(xb)
+            h_cols = torch.empty(n, len(feats), device=device)
+            for lo in range(0, n, cfg.collection.chunk_size):
+                hi = min(lo + cfg.collection.chunk_size, n)
+                h = torch.from_numpy(index.rows(np.arange(lo, hi))).to(device)
+                recon_base[lo:hi] = sae.decode(h)
+                h_cols[lo:hi] = h.index_select(1, cols)
+        else:
+            h_base = sae.encode(xb)
+            recon_base = sae.decode(h_base)
+            h_cols = h_base.index_select(1, cols)
+            del h_base
+    d_sae = sae.encoder.out_features
 
     base_err = recon_base - xb
     base_mse = float((base_err.pow(2).mean()).item())
@@ -136,23 +147,23 @@ def main() -> None:
     rows = []
 
     def run_one(feature_idx: int, group: str):
-        base_feature_mean = float(h_base[:, feature_idx].mean().item())
-        base_feature_freq = float((h_base[:, feature_idx] > 0).float().mean().item())
+        base = h_cols[:, col_of[feature_idx]]
+        base_feature_mean = float(base.mean().item())
+        base_feature_freq = float((base > 0).float().mean().item())
 
         for a in alphas:
             with torch.no_grad():
-                h = h_base.clone()
-                h[:, feature_idx] = h[:, feature_idx] * a
-                recon = sae.decoder(h)
+                target = base * a
+                recon = recon_base + (target - base).unsqueeze(1) * sae.decoder.weight[:, feature_idx]
 
             err = recon - xb
             mse = float((err.pow(2).mean()).item())
             r2 = float(1.0 - mse / max(var, 1e-8))
 
-            # latent perturbation magnitude for this intervention
-            delta_latent = float((h - h_base).abs().mean().item())
-            target_delta = float((h[:, feature_idx] - h_base[:, feature_idx]).abs().mean().item())
-            target_mean = float(h[:, feature_idx].mean().item())
+            # latent perturbation magnitude for this intervention (only column feature_idx moves)
+            target_delta = float((target - base).abs().mean().item())
+            delta_latent = target_delta / d_sae
+            target_mean = float(target.mean().item())
 
             rows.append(
                 {
@@ -1,7 +1,6 @@
 from __future__ import annotations
 
 import argparse
-import json
 from pathlib import Path
 
 import matplotlib.pyplot as plt
@@ -11,20 +10,13 @@ import torch
 from sklearn.cluster import KMeans
 from sklearn.decomposition import PCA
 
+from .activation_store import open_label_store
 from .config import load_config
+from .feature_index import open_index
 from .sae import SparseAutoencoder
 from .utils import get_device, set_seed
 
 
-def _load_acts(cfg, label: str):
-    with open(Path(cfg.collection.output_dir) / f"meta_{label}.json", "r", encoding="utf-8") as f:
-        meta = json.load(f)
-    n = int(meta["tokens_collected"])
-    d_model = int(meta["d_model"])
-    mmap = np.memmap(meta["acts_path"], mode="r", dtype=np.float16, shape=(cfg.collection.__dict__[f"tokens_{label.lower()}"], d_model))
-    return np.array(mmap[:n], dtype=np.float32), d_model
-
-
 def main() -> None:
     ap = argparse.ArgumentParser()
     ap.add_argument("--config", required=True)
@@ -35,13 +27,12 @@ def main() -> None:
     cfg = load_config(args.config)
     set_seed(cfg.seed)
 
-    xA, d_model = _load_acts(cfg, "A")
-    xB, _ = _load_acts(cfg, "B")
+    storeA, _ = open_label_store(cfg.collection.output_dir, "A", cfg)
+    storeB, _ = open_label_store(cfg.collection.output_dir, "B", cfg)
+    d_model = storeA.d_model
 
-    n = min(args.sample_per_domain, len(xA), len(xB))
+    n = min(args.sample_per_domain, len(storeA), len(storeB))
     rng = np.random.default_rng(cfg.seed)
-    xa = xA[rng.choice(len(xA), size=n, replace=False)]
-    xb = xB[rng.choice(len(xB), size=n, replace=False)]
 
     device = get_device(cfg.device_preference)
     sae = SparseAutoencoder(d_model=d_model, d_sae=cfg.sae.d_sae, sparsity_mode=cfg.sae.sparsity_mode, topk=cfg.sae.topk).to(device)
@@ -49,9 +40,17 @@ def main() -> None:
     sae.load_state_dict(torch.load(ckpt, map_location=device))
     sae.eval()
 
-    with torch.no_grad():
-        hA = sae.encode(torch.from_numpy(xa).to(device)).cpu().numpy()
-        hB = sae.encode(torch.from_numpy(xb).to(device)).cpu().numpy()
+    indexA, indexB = open_index(cfg, "A", "A"), open_index(cfg, "A", "B")
+    if indexA is not None and indexB is not None:
+        # the same rows ActivationStore.sample would draw
+        hA = indexA.rows(rng.choice(len(storeA), size=n, replace=False))
+        hB = indexB.rows(rng.choice(len(storeB), size=n, replace=False))
+    else:
+        xa = storeA.sample(n, rng).astype(np.float32)
+        xb = storeB.sample(n, rng).astype(np.float32)
+        with torch.no_grad():
+            hA = sae.encode(torch.from_numpy(xa).to(device)).cpu().numpy()
+            hB = sae.encode(torch.from_numpy(xb).to(device)).cpu().numpy()
 
     freqA = (hA > 0).mean(axis=0)
     freqB = (hB > 0).mean(axis=0)
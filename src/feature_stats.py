@@ -0,0 +1,87 @@
+from __future__ import annotations
+
+from typing import Generator
+
+import numpy as np
+import torch
+
+from .activation_store import ActivationStore
+
+
+def encode_chunks(
+    sae, store: ActivationStore, device: torch.device, chunk_rows: int
+) -> Generator[tuple[int, torch.Tensor], None, None]:
+    """
+    Yield (row_offset, codes) for the whole store, encoded `chunk_rows` rows at a time.
+
+    The codes live in the SAE's reused workspace and are overwritten by the next chunk.
+    """
+    for lo, chunk in store.iter_chunks(chunk_rows):
+        with torch.no_grad():
+            h = sae.encode_inference(torch.from_numpy(np.array(chunk)).to(device).float(), reuse=True)
+        yield lo, h
+
+
+def feature_stats(sae, store: ActivationStore, device: torch.device, chunk_rows: int) -> dict[str, np.ndarray]:
+    """Per-feature firing frequency, mean and max activation in one streamed pass."""
+    # running sums live on the CPU in float64 (MPS has no float64)
+    d_sae = sae.encoder.out_features
+    fire = torch.zeros(d_sae, dtype=torch.float64)
+    total = torch.zeros(d_sae, dtype=torch.float64)
+    peak = torch.full((d_sae,), -float("inf"), dtype=torch.float64)
+    n = 0
+    for _, h in encode_chunks(sae, store, device, chunk_rows):
+        fire += (h > 0).sum(dim=0).cpu().double()
+        total += h.sum(dim=0).cpu().double()
+        peak = torch.maximum(peak, h.max(dim=0).values.cpu().double())
+        n += h.shape[0]
+    return {
+        "freq": (fire / max(n, 1)).numpy(),
+        "mean": (total / max(n, 1)).numpy(),
+        "max": peak.numpy(),
+    }
+
+
+def top_indices(score: np.ndarray, k: int) -> np.ndarray:
+    """Indices of the `k` largest entries of `score`, largest first (argpartition, then sort k)."""
+    k = min(k, score.shape[0])
+    if k <= 0:
+        return np.zeros(0, dtype=np.int64)
+    part = np.argpartition(score, -k)[-k:]
+    return part[np.argsort(score[part])[::-1]]
+
+
+def merge_topk(
+    best_vals: torch.Tensor, best_idx: torch.Tensor, h: torch.Tensor, lo: int, k: int
+) -> tuple[torch.Tensor, torch.Tensor]:
+    """Fold chunk `h` (rows starting at token `lo`) into the running per-column [k, F] top values/tokens."""
+    vals, idx = torch.topk(h, min(k, h.shape[0]), dim=0)
+    vals = torch.cat([best_vals, vals])
+    idx = torch.cat([best_idx, idx + lo])
+    best_vals, pick = torch.topk(vals, min(k, vals.shape[0]), dim=0)
+    return best_vals, idx.gather(0, pick)
+
+
+def top_activations(
+    sae,
+    store: ActivationStore,
+    device: torch.device,
+    chunk_rows: int,
+    features: np.ndarray,
+    k: int,
+) -> dict[int, list[tuple[float, int]]]:
+    """
+    The `k` largest (value, token_index) pairs of each feature in `features`, largest first.
+
+    One pass: each chunk's selected columns go through a single `torch.topk(dim=0)` and are
+    merged on the device with the running [k, F] best, so only k rows per feature are kept.
+    """
+    feats = [int(f) for f in features]
+    cols = torch.as_tensor(feats, dtype=torch.long, device=device)
+    best_vals = torch.empty(0, len(feats), device=device)
+    best_idx = torch.empty(0, len(feats), dtype=torch.long, device=device)
+    for lo, h in encode_chunks(sae, store, device, chunk_rows):
+        best_vals, best_idx = merge_topk(best_vals, best_idx, h.index_select(1, cols).float(), lo, k)
+    vals = best_vals.t().cpu().tolist()
+    idx = best_idx.t().cpu().tolist()
+    return {f: list(zip(v, i)) for f, v, i in zip(feats, vals, idx)}
@@ -8,8 +8,12 @@ from pathlib import Path
 import numpy as np
 import torch
 
+from .activation_store import open_label_store
 from .config import load_config
-from .model import load_model_and_tokenizer
+from .context_snippets import ContextSnippets
+from .feature_index import open_index
+from .feature_stats import feature_stats, top_activations, top_indices
+from .model import load_tokenizer
 from .sae import SparseAutoencoder
 from .utils import get_device, set_seed
 
@@ -36,56 +40,49 @@ def main() -> None:
     feats_dir = Path(cfg.outputs.features_dir)
     feats_dir.mkdir(parents=True, exist_ok=True)
 
-    with open(acts_dir / f"meta_{args.label}.json", "r", encoding="utf-8") as f:
-        meta = json.load(f)
-
-    n = int(meta["tokens_collected"])
-    d_model = int(meta["d_model"])
-    acts = np.memmap(meta["acts_path"], mode="r", dtype=np.float16, shape=(cfg.collection.__dict__[f'tokens_{args.label.lower()}'], d_model))
-    x = torch.from_numpy(np.array(acts[:n], dtype=np.float32))
+    store, meta = open_label_store(acts_dir, args.label, cfg)
+    d_model = store.d_model
 
     token_ids = np.load(meta["tokens_path"])
 
     device = get_device(cfg.device_preference)
-    hooked = load_model_and_tokenizer(cfg.model.model_name, cfg.model.dtype, device)
-
-    sae = SparseAutoencoder(
-        d_model=d_model,
-        d_sae=cfg.sae.d_sae,
-        sparsity_mode=cfg.sae.sparsity_mode,
-        topk=cfg.sae.topk,
-    ).to(device)
-    ckpt = Path(cfg.outputs.checkpoints_dir) / f"sae_{args.label}.pt"
-    sae.load_state_dict(torch.load(ckpt, map_location=device))
-    sae.eval()
-
-    with torch.no_grad():
-        h = sae.encode(x.to(device)).cpu().numpy()
-
-    freq = (h > 0).mean(axis=0)
-    mag = h.mean(axis=0)
-    score = freq * mag
-    top_features = np.argsort(score)[::-1][: cfg.interpret.top_features]
+    tokenizer = load_tokenizer(cfg.model.model_name)
+
+    index = open_index(cfg, args.label, args.label, cfg.interpret.top_contexts)
+    if index is None:
+        sae = SparseAutoencoder(
+            d_model=d_model,
+            d_sae=cfg.sae.d_sae,
+            sparsity_mode=cfg.sae.sparsity_mode,
+            topk=cfg.sae.topk,
+        ).to(device)
+        ckpt = Path(cfg.outputs.checkpoints_dir) / f"sae_{args.label}.pt"
+        sae.load_state_dict(torch.load(ckpt, map_location=device))
+        sae.eval()
+        chunk_rows = cfg.collection.chunk_size
+        stats = feature_stats(sae, store, device, chunk_rows)
+    else:
+        stats = index.stats()
+
+    score = stats["freq"] * stats["mean"]
+    top_features = top_indices(score, cfg.interpret.top_features)
+    if index is None:
+        tops = top_activations(sae, store, device, chunk_rows, top_features, cfg.interpret.top_contexts)
+    else:
+        tops = index.top_activations(top_features, cfg.interpret.top_contexts)
 
     results = {}
-    win = cfg.interpret.context_window_tokens
+    snippets = ContextSnippets(tokenizer, token_ids, cfg.interpret.context_window_tokens)
+    snippets.prefetch(i for pairs in tops.values() for _, i in pairs)
 
     for f_idx in top_features:
-        col = h[:, f_idx]
-        top_idx = np.argsort(col)[::-1][: cfg.interpret.top_contexts]
-        contexts = []
-        vals = []
-        for i in top_idx:
-            lo = max(0, i - win)
-            hi = min(len(token_ids), i + win + 1)
-            snippet = hooked.tokenizer.decode(token_ids[lo:hi], skip_special_tokens=True)
-            contexts.append(snippet)
-            vals.append(float(col[i]))
+        contexts = [snippets[i] for _, i in tops[int(f_idx)]]
+        vals = [v for v, _ in tops[int(f_idx)]]
         results[str(int(f_idx))] = {
             "feature_index": int(f_idx),
-            "activation_mean": float(col.mean()),
-            "activation_max": float(col.max()),
-            "activation_frequency": float((col > 0).mean()),
+            "activation_mean": float(stats["mean"][f_idx]),
+            "activation_max": float(stats["max"][f_idx]),
+            "activation_frequency": float(stats["freq"][f_idx]),
             "heuristic_label": heuristic_label(contexts),
             "top_contexts": contexts,
             "top_values": vals,
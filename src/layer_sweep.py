@@ -93,10 +93,26 @@ def main() -> None:
     layers = [int(x.strip()) for x in args.layers.split(",") if x.strip()]
     base = _read_yaml(Path(args.config))
 
+    layer_cfgs = {layer: _layer_cfg(base, layer) for layer in layers}
+
+    if args.stage in {"collect", "all"}:
+        # one model pass records every layer into the per-layer activation dirs used below
+        _run(
+            [
+                "python",
+                "-m",
+                "src.collect_acts",
+                "--config",
+                args.config,
+                "--layers",
+                ",".join(str(layer) for layer in layers),
+                "--output-template",
+                str(Path("artifacts/layer_sweep") / "layer_{layer}" / "activations"),
+            ]
+        )
+
     for layer in layers:
-        lc = _layer_cfg(base, layer)
-        if args.stage in {"collect", "all"}:
-            _run(["python", "-m", "src.collect_acts", "--config", str(lc)])
+        lc = layer_cfgs[layer]
         if args.stage in {"train", "all"}:
             _run(["python", "-m", "src.train_sae", "--config", str(lc)])
             _run(["python", "-m", "src.interpret", "--config", str(lc), "--label", "A"])
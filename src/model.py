@@ -1,17 +1,44 @@
 from __future__ import annotations
 
+import hashlib
 from contextlib import contextmanager
-from dataclasses import dataclass
-from typing import Generator
+from typing import Any, Callable, Generator
 
 import torch
 from transformers import AutoModelForCausalLM, AutoTokenizer
 
 
-@dataclass
 class HookedModel:
-    tokenizer: any
-    model: torch.nn.Module
+    """
+    Tokenizer plus causal LM. Given `loader` instead of `model`, the weights are loaded on the
+    first `.model` access, so tokenizer-only users never pay for them.
+    """
+
+    def __init__(
+        self,
+        tokenizer: Any,
+        model: torch.nn.Module | None = None,
+        loader: Callable[[], torch.nn.Module] | None = None,
+    ):
+        if model is None and loader is None:
+            raise ValueError("HookedModel needs a model or a loader.")
+        self.tokenizer = tokenizer
+        self._model = model
+        self._loader = loader
+
+    @property
+    def model(self) -> torch.nn.Module:
+        if self._model is None:
+            self._model = self._loader()
+            self._loader = None
+        return self._model
+
+
+def load_tokenizer(model_name: str):
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    if tokenizer.pad_token is None:
+        tokenizer.pad_token = tokenizer.eos_token
+    return tokenizer
 
 
 def load_model_and_tokenizer(model_name: str, dtype: str = "float16", device: torch.device | None = None) -> HookedModel:
@@ -21,16 +48,36 @@ def load_model_and_tokenizer(model_name: str, dtype: str = "float16", device: to
         "float32": torch.float32,
     }.get(dtype, torch.float16)
 
-    tokenizer = AutoTokenizer.from_pretrained(model_name)
-    if tokenizer.pad_token is None:
-        tokenizer.pad_token = tokenizer.eos_token
+    tokenizer = load_tokenizer(model_name)
+
+    def loader() -> torch.nn.Module:
+        model = AutoModelForCausalLM.from_pretrained(model_name, dtype=torch_dtype)
+        model.eval()
+        if device is not None:
+            model.to(device)
+        return model
+
+    return HookedModel(tokenizer=tokenizer, loader=loader)
+
 
-    model = AutoModelForCausalLM.from_pretrained(model_name, dtype=torch_dtype)
-    model.eval()
-    if device is not None:
-        model.to(device)
+def model_fingerprint(model: torch.nn.Module, sample: int = 4096) -> str:
+    """
+    Short stable hash of the model's name, architecture config and weights.
 
-    return HookedModel(tokenizer=tokenizer, model=model)
+    The weight digest covers the first, middle and last parameter tensors, each through an
+    evenly strided sample of at most `sample` values, so it stays cheap for large models.
+    """
+    cfg = model.config
+    payload = f"{getattr(cfg, '_name_or_path', '')}\n{cfg.to_json_string(use_diff=False)}"
+    h = hashlib.sha256(payload.encode("utf-8"))
+    params = list(model.named_parameters())
+    for i in sorted({0, len(params) // 2, len(params) - 1} if params else set()):
+        name, p = params[i]
+        flat = p.detach().reshape(-1)
+        picked = flat[:: max(flat.numel() // sample, 1)][:sample]
+        h.update(f"\n{name} {tuple(p.shape)} {p.dtype}\n".encode("utf-8"))
+        h.update(picked.float().cpu().numpy().tobytes())
+    return h.hexdigest()[:16]
 
 
 def get_transformer_blocks(model: torch.nn.Module):
@@ -57,6 +104,48 @@ def get_transformer_block(model: torch.nn.Module, layer_index: int):
     return blocks[layer_index]
 
 
+def get_decoder_stack(model: torch.nn.Module) -> torch.nn.Module:
+    """Return the base decoder (embeddings + `.layers` + final norm) without the LM head."""
+    if hasattr(model, "gpt_neox") and hasattr(model.gpt_neox, "layers"):
+        return model.gpt_neox
+    if hasattr(model, "model") and hasattr(model.model, "layers"):
+        return model.model
+    raise ValueError(
+        "Unsupported model architecture for truncated forward. "
+        "Expected GPTNeoX-style (model.gpt_neox) or Llama/Gemma-style (model.model)."
+    )
+
+
+# GPTNeoX: final_layer_norm; Llama/Gemma: norm
+_FINAL_NORM_ATTRS = ("final_layer_norm", "norm")
+
+
+@contextmanager
+def truncated_forward(model: torch.nn.Module, last_layer: int) -> Generator[torch.nn.Module, None, None]:
+    """
+    Temporarily cut the model down to embeddings + blocks 0..last_layer.
+
+    Yields the base decoder stack with its block list truncated and its final norm replaced
+    by Identity; calling it never runs the remaining blocks or the LM head, so no
+    [batch, seq, vocab] logits are allocated. Hooks on blocks 0..last_layer fire as usual.
+    """
+    stack = get_decoder_stack(model)
+    blocks = get_transformer_blocks(model)
+    if not 0 <= last_layer < len(blocks):
+        raise IndexError(f"last_layer={last_layer} out of range for a {len(blocks)}-block model.")
+
+    norms = {attr: getattr(stack, attr) for attr in _FINAL_NORM_ATTRS if isinstance(getattr(stack, attr, None), torch.nn.Module)}
+    stack.layers = torch.nn.ModuleList(list(blocks)[: last_layer + 1])
+    for attr in norms:
+        setattr(stack, attr, torch.nn.Identity())
+    try:
+        yield stack
+    finally:
+        stack.layers = blocks
+        for attr, module in norms.items():
+            setattr(stack, attr, module)
+
+
 def register_mlp_output_hook(model: torch.nn.Module, layer_index: int, hook_fn):
     """
     Register a forward hook on the block MLP output for supported model families.
@@ -73,26 +162,43 @@ def register_mlp_output_hook(model: torch.nn.Module, layer_index: int, hook_fn):
     )
 
 
-@contextmanager
-def activation_collector(model: torch.nn.Module, layer_index: int, stream: str = "mlp_output") -> Generator[list[torch.Tensor], None, None]:
-    acts: list[torch.Tensor] = []
-
+def _register_site_hook(model: torch.nn.Module, layer_index: int, stream: str, sink: list[torch.Tensor]):
     def hook_mlp(_module, _inp, out):
-        acts.append(out.detach())
+        sink.append(out.detach())
 
     def hook_resid(_module, _inp, out):
         # hidden_states from full block output
-        acts.append(out[0].detach() if isinstance(out, tuple) else out.detach())
+        sink.append(out[0].detach() if isinstance(out, tuple) else out.detach())
 
-    block = get_transformer_block(model, layer_index)
     if stream == "mlp_output":
-        handle = register_mlp_output_hook(model, layer_index, hook_mlp)
-    elif stream == "residual":
-        handle = block.register_forward_hook(hook_resid)
-    else:
-        raise ValueError(f"Unsupported activation_stream: {stream}")
+        return register_mlp_output_hook(model, layer_index, hook_mlp)
+    if stream == "residual":
+        return get_transformer_block(model, layer_index).register_forward_hook(hook_resid)
+    raise ValueError(f"Unsupported activation_stream: {stream}")
+
 
+@contextmanager
+def activation_collector(model: torch.nn.Module, layer_index: int, stream: str = "mlp_output") -> Generator[list[torch.Tensor], None, None]:
+    acts: list[torch.Tensor] = []
+    handle = _register_site_hook(model, layer_index, stream, acts)
     try:
         yield acts
     finally:
         handle.remove()
+
+
+@contextmanager
+def multi_activation_collector(
+    model: torch.nn.Module,
+    sites: list[tuple[int, str]],
+) -> Generator[dict[tuple[int, str], list[torch.Tensor]], None, None]:
+    """Record every (layer_index, stream) site during a single forward pass."""
+    acts: dict[tuple[int, str], list[torch.Tensor]] = {site: [] for site in sites}
+    handles = []
+    try:
+        for layer_index, stream in sites:
+            handles.append(_register_site_hook(model, layer_index, stream, acts[(layer_index, stream)]))
+        yield acts
+    finally:
+        for handle in handles:
+            handle.remove()
@@ -38,7 +38,7 @@ def residual_intervention_hook_factory(
         dt = x.dtype
         with torch.no_grad():
             xf = x.float()
-            h0 = sae.encode(xf)
+            h0 = sae.encode_inference(xf)
             h1 = h0.clone()
             h1[..., feature_idx] = h1[..., feature_idx] * alpha
             delta = sae.decoder(h1) - sae.decoder(h0)
@@ -11,8 +11,12 @@ import numpy as np
 import pandas as pd
 import torch
 
+from .activation_store import open_label_store
 from .config import load_config
-from .model import load_model_and_tokenizer
+from .context_snippets import ContextSnippets
+from .feature_index import open_index
+from .feature_stats import feature_stats, top_activations, top_indices
+from .model import load_tokenizer
 from .sae import SparseAutoencoder
 from .utils import get_device, set_seed
 
@@ -120,34 +124,30 @@ def main() -> None:
     out_dir = Path(cfg.outputs.features_dir)
     out_dir.mkdir(parents=True, exist_ok=True)
 
-    with open(acts_dir / f"meta_{args.label}.json", "r", encoding="utf-8") as f:
-        meta = json.load(f)
-
-    n = int(meta["tokens_collected"])
-    d_model = int(meta["d_model"])
-    total_alloc = cfg.collection.__dict__[f"tokens_{args.label.lower()}"]
-    acts = np.memmap(meta["acts_path"], mode="r", dtype=np.float16, shape=(total_alloc, d_model))
-    x = torch.from_numpy(np.array(acts[:n], dtype=np.float32))
+    store, meta = open_label_store(acts_dir, args.label, cfg)
+    d_model = store.d_model
     token_ids = np.load(meta["tokens_path"])
 
     device = get_device(cfg.device_preference)
-    hooked = load_model_and_tokenizer(cfg.model.model_name, cfg.model.dtype, device)
-
-    sae = SparseAutoencoder(
-        d_model=d_model,
-        d_sae=cfg.sae.d_sae,
-        sparsity_mode=cfg.sae.sparsity_mode,
-        topk=cfg.sae.topk,
-    ).to(device)
-    ckpt = Path(cfg.outputs.checkpoints_dir) / f"sae_{args.label}.pt"
-    sae.load_state_dict(torch.load(ckpt, map_location=device))
-    sae.eval()
-
-    with torch.no_grad():
-        h = sae.encode(x.to(device)).cpu().numpy()
-
-    freq = (h > 0).mean(axis=0)
-    mag = h.mean(axis=0)
+    tokenizer = load_tokenizer(cfg.model.model_name)
+
+    index = open_index(cfg, args.label, args.label, args.top_contexts)
+    if index is None:
+        sae = SparseAutoencoder(
+            d_model=d_model,
+            d_sae=cfg.sae.d_sae,
+            sparsity_mode=cfg.sae.sparsity_mode,
+            topk=cfg.sae.topk,
+        ).to(device)
+        ckpt = Path(cfg.outputs.checkpoints_dir) / f"sae_{args.label}.pt"
+        sae.load_state_dict(torch.load(ckpt, map_location=device))
+        sae.eval()
+        chunk_rows = cfg.collection.chunk_size
+        stats = feature_stats(sae, store, device, chunk_rows)
+    else:
+        stats = index.stats()
+    freq = stats["freq"]
+    mag = stats["mean"]
     activity = freq * mag
     specificity = 1.0 - freq
 
@@ -161,23 +161,20 @@ def main() -> None:
         )
 
     pre_score = activity[valid_idx] * np.sqrt(np.clip(specificity[valid_idx], 1e-8, 1.0))
-    shortlist = valid_idx[np.argsort(pre_score)[::-1][: args.top_features]]
+    shortlist = valid_idx[top_indices(pre_score, args.top_features)]
+    if index is None:
+        tops = top_activations(sae, store, device, chunk_rows, shortlist, args.top_contexts)
+    else:
+        tops = index.top_activations(shortlist, args.top_contexts)
+    snippets = ContextSnippets(tokenizer, token_ids, args.window)
+    snippets.prefetch(i for pairs in tops.values() for _, i in pairs)
 
     rows: list[dict] = []
     cards: dict[str, dict] = {}
 
     for f_idx in shortlist:
-        col = h[:, f_idx]
-        top_idx = np.argsort(col)[::-1][: args.top_contexts]
-
-        contexts: list[str] = []
-        vals: list[float] = []
-        for i in top_idx:
-            lo = max(0, int(i) - args.window)
-            hi = min(len(token_ids), int(i) + args.window + 1)
-            snippet = hooked.tokenizer.decode(token_ids[lo:hi], skip_special_tokens=True)
-            contexts.append(snippet)
-            vals.append(float(col[i]))
+        contexts = [snippets[i] for _, i in tops[int(f_idx)]]
+        vals = [v for v, _ in tops[int(f_idx)]]
 
         words = _tokenize_words(contexts)
         coherence, keywords, top_words = _coherence_score(words)
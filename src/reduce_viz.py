@@ -1,7 +1,6 @@
 from __future__ import annotations
 
 import argparse
-import json
 from pathlib import Path
 
 import matplotlib.pyplot as plt
@@ -10,23 +9,13 @@ import pandas as pd
 import torch
 from sklearn.decomposition import PCA
 
+from .activation_store import open_label_store
 from .config import load_config
+from .feature_index import open_index
 from .sae import SparseAutoencoder
 from .utils import get_device, set_seed
 
 
-def _load_dataset(cfg, label: str):
-    with open(Path(cfg.collection.output_dir) / f"meta_{label}.json", "r", encoding="utf-8") as f:
-        meta = json.load(f)
-    n = int(meta["tokens_collected"])
-    d_model = int(meta["d_model"])
-    mmap = np.memmap(
-        meta["acts_path"], mode="r", dtype=np.float16, shape=(cfg.collection.__dict__[f"tokens_{label.lower()}"], d_model)
-    )
-    x = np.array(mmap[:n], dtype=np.float32)
-    return x, d_model
-
-
 def main() -> None:
     ap = argparse.ArgumentParser()
     ap.add_argument("--config", required=True)
@@ -36,31 +25,39 @@ def main() -> None:
     cfg = load_config(args.config)
     set_seed(cfg.seed)
 
-    xA, d_model = _load_dataset(cfg, "A")
-    xB, _ = _load_dataset(cfg, "B")
+    storeA, _ = open_label_store(cfg.collection.output_dir, "A", cfg)
+    storeB, _ = open_label_store(cfg.collection.output_dir, "B", cfg)
+    d_model = storeA.d_model
 
     # balanced sampling
-    n_each = min(len(xA), len(xB), args.max_points // 2)
+    n_each = min(len(storeA), len(storeB), args.max_points // 2)
     rng = np.random.default_rng(cfg.seed)
-    idxA = rng.choice(len(xA), size=n_each, replace=False)
-    idxB = rng.choice(len(xB), size=n_each, replace=False)
-
-    x = np.concatenate([xA[idxA], xB[idxB]], axis=0)
     domain = np.array([0] * n_each + [1] * n_each)
 
-    device = get_device(cfg.device_preference)
-    sae = SparseAutoencoder(
-        d_model=d_model,
-        d_sae=cfg.sae.d_sae,
-        sparsity_mode=cfg.sae.sparsity_mode,
-        topk=cfg.sae.topk,
-    ).to(device)
-    ckpt = Path(cfg.outputs.checkpoints_dir) / "sae_A.pt"
-    sae.load_state_dict(torch.load(ckpt, map_location=device))
-    sae.eval()
-
-    with torch.no_grad():
-        h = sae.encode(torch.from_numpy(x).to(device)).cpu().numpy()
+    indexA, indexB = open_index(cfg, "A", "A"), open_index(cfg, "A", "B")
+    if indexA is not None and indexB is not None:
+        # the same rows ActivationStore.sample would draw
+        hA = indexA.rows(rng.choice(len(storeA), size=n_each, replace=False))
+        hB = indexB.rows(rng.choice(len(storeB), size=n_each, replace=False))
+        h = np.concatenate([hA, hB], axis=0)
+    else:
+        xA = storeA.sample(n_each, rng)
+        xB = storeB.sample(n_each, rng)
+        x = np.concatenate([xA, xB], axis=0).astype(np.float32)
+
+        device = get_device(cfg.device_preference)
+        sae = SparseAutoencoder(
+            d_model=d_model,
+            d_sae=cfg.sae.d_sae,
+            sparsity_mode=cfg.sae.sparsity_mode,
+            topk=cfg.sae.topk,
+        ).to(device)
+        ckpt = Path(cfg.outputs.checkpoints_dir) / "sae_A.pt"
+        sae.load_state_dict(torch.load(ckpt, map_location=device))
+        sae.eval()
+
+        with torch.no_grad():
+            h = sae.encode(torch.from_numpy(x).to(device)).cpu().numpy()
 
     # use PCA for robust + fast 2D/3D projections
     pca3 = PCA(n_components=3, random_state=cfg.seed)
@@ -1,36 +1,159 @@
 from __future__ import annotations
 
 from dataclasses import dataclass
+from typing import Any
 
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
 
+def _bag_sum(rows: torch.Tensor, idx: torch.Tensor, vals: torch.Tensor) -> torch.Tensor:
+    """sum_j vals[:, j] * rows[idx[:, j]] for idx/vals [N, k] and rows [d_sae, d_model]."""
+    if rows.device.type in ("cpu", "cuda"):
+        return F.embedding_bag(idx, rows, per_sample_weights=vals, mode="sum")
+    return (rows[idx] * vals.unsqueeze(-1)).sum(dim=-2)
+
+
+class _SparseDecode(torch.autograd.Function):
+    """
+    Top-k decode reading only the k selected rows of a row-major copy of the decoder weight.
+
+    `rows` is a detached [d_sae, d_model] copy of `weight` ([d_model, d_sae]); the weight
+    gradient is scattered into the selected rows and returned transposed for `weight`.
+    """
+
+    @staticmethod
+    def forward(ctx, vals: torch.Tensor, idx: torch.Tensor, weight: torch.Tensor, rows: torch.Tensor) -> torch.Tensor:
+        cast = vals.to(rows.dtype)
+        ctx.save_for_backward(cast, idx, rows)
+        ctx.vals_dtype = vals.dtype
+        return _bag_sum(rows, idx, cast)
+
+    @staticmethod
+    def backward(ctx, grad: torch.Tensor):
+        vals, idx, rows = ctx.saved_tensors
+        grad = grad.to(rows.dtype)
+        grad_vals = grad_weight = None
+        if ctx.needs_input_grad[0]:
+            grad_vals = (rows[idx] * grad.unsqueeze(-2)).sum(dim=-1).to(ctx.vals_dtype)
+        if ctx.needs_input_grad[2]:
+            contrib = (vals.unsqueeze(-1) * grad.unsqueeze(-2)).reshape(-1, rows.shape[1])
+            grad_weight = torch.zeros_like(rows).index_add_(0, idx.reshape(-1), contrib).t()
+        return grad_vals, None, grad_weight, None
+
+
 class SparseAutoencoder(nn.Module):
     def __init__(self, d_model: int, d_sae: int, sparsity_mode: str = "relu_l1", topk: int = 64):
         super().__init__()
         self.encoder = nn.Linear(d_model, d_sae, bias=True)
         self.decoder = nn.Linear(d_sae, d_model, bias=False)
+        # Pre-encoder bias: subtracted before encoding, added back after decoding. Fixed at zero
+        # unless a trainer initializes it (see `sae.b_pre_init`).
+        self.b_pre = nn.Parameter(torch.zeros(d_model), requires_grad=False)
         self.sparsity_mode = sparsity_mode
         self.topk = topk
+        self._workspace: dict[str, Any] = {}
+        self._decoder_rows: tuple[tuple, torch.Tensor] | None = None
         nn.init.xavier_uniform_(self.encoder.weight)
         nn.init.xavier_uniform_(self.decoder.weight)
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # Checkpoints written before b_pre existed have an implicit zero pre-encoder bias.
+        state_dict.setdefault(prefix + "b_pre", torch.zeros_like(self.b_pre))
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    @torch.no_grad()
+    def normalize_decoder_(self) -> None:
+        """Project decoder columns (one per latent) back to unit L2 norm."""
+        w = self.decoder.weight
+        w.div_(w.norm(dim=0, keepdim=True).clamp_min(1e-8))
+
+    def encode_topk(self, x: torch.Tensor) -> tuple[torch.Tensor, torch.Tensor]:
+        """Top-k codes as (values, indices), each [..., k]; values are post-ReLU."""
+        pre = self.encoder(x - self.b_pre)
+        k = min(self.topk, pre.shape[-1])
+        vals, idx = torch.topk(pre, k=k, dim=-1)
+        return F.relu(vals), idx
+
+    def _rows(self) -> torch.Tensor:
+        """Row-major [d_sae, d_model] copy of the decoder weight, rebuilt only when the weight changes."""
+        w = self.decoder.weight
+        key = (w._version, w.data_ptr(), w.dtype, w.device, torch.is_inference_mode_enabled())
+        if self._decoder_rows is None or self._decoder_rows[0] != key:
+            # A fresh tensor each time: backward passes may still hold the previous copy.
+            self._decoder_rows = (key, w.detach().t().contiguous())
+        return self._decoder_rows[1]
+
+    def decode_sparse(self, vals: torch.Tensor, idx: torch.Tensor) -> torch.Tensor:
+        """
+        Decode top-k codes touching only the k selected decoder rows per input.
+
+        Reads a cached row-major copy of the decoder (refreshed after each in-place update, i.e.
+        once per optimizer step); gradients still reach `decoder.weight`.
+        """
+        lead = idx.shape[:-1]
+        flat_idx = idx.reshape(-1, idx.shape[-1])
+        flat_vals = vals.reshape(-1, vals.shape[-1])
+        out = _SparseDecode.apply(flat_vals, flat_idx, self.decoder.weight, self._rows())
+        return out.reshape(*lead, out.shape[-1]) + self.b_pre
+
+    def _densify(self, vals: torch.Tensor, idx: torch.Tensor) -> torch.Tensor:
+        shape = (*idx.shape[:-1], self.encoder.out_features)
+        return torch.zeros(shape, dtype=vals.dtype, device=vals.device).scatter(-1, idx, vals)
+
     def encode(self, x: torch.Tensor) -> torch.Tensor:
-        pre = self.encoder(x)
-        h = F.relu(pre)
         if self.sparsity_mode == "topk":
-            k = min(self.topk, h.shape[-1])
-            vals, idx = torch.topk(h, k=k, dim=-1)
-            mask = torch.zeros_like(h)
-            mask.scatter_(dim=-1, index=idx, src=torch.ones_like(vals))
-            h = h * mask
-        return h
+            return self._densify(*self.encode_topk(x))
+        return F.relu(self.encoder(x - self.b_pre))
+
+    def decode(self, h: torch.Tensor) -> torch.Tensor:
+        return self.decoder(h) + self.b_pre
+
+    def encode_inference(self, x: torch.Tensor, reuse: bool = False) -> torch.Tensor:
+        """
+        `encode` for no-grad / inference-mode callers, without the dense top-k mask.
+
+        The encoder runs as one `addmm` with `b_pre` folded into the bias and top-k results are
+        scattered back into that buffer. By default every call returns a fresh tensor. With
+        `reuse=True` the buffers are kept on the module for the next call of the same shape
+        (one shape at a time, for streams of fixed-size chunks): the returned tensor is then
+        overwritten by that call, so consume or copy it first. Falls back to `encode` while
+        autograd is recording.
+        """
+        if torch.is_grad_enabled():
+            return self.encode(x)
+        w = self.encoder.weight
+        lead = x.shape[:-1]
+        x2 = x.reshape(-1, x.shape[-1]).to(w.dtype)
+        n, d_sae = x2.shape[0], w.shape[0]
+        k = min(self.topk, d_sae)
+        ws = {}
+        if reuse:
+            key = (tuple(x2.shape), w.dtype, w.device, torch.is_inference_mode_enabled())
+            if self._workspace.get("key") != key:
+                self._workspace = {"key": key, "pre": torch.empty(n, d_sae, dtype=w.dtype, device=w.device)}
+                if self.sparsity_mode == "topk":
+                    self._workspace["vals"] = torch.empty(n, k, dtype=w.dtype, device=w.device)
+                    self._workspace["idx"] = torch.empty(n, k, dtype=torch.long, device=w.device)
+            ws = self._workspace
+
+        # encoder(x - b_pre) with b_pre folded into the bias, so x is never copied.
+        bias = torch.addmv(self.encoder.bias, w, self.b_pre, alpha=-1)
+        pre = torch.addmm(bias, x2, w.t(), out=ws.get("pre"))
+        if self.sparsity_mode != "topk":
+            return pre.relu_().view(*lead, -1)
+        out = (ws["vals"], ws["idx"]) if ws else None
+        vals, idx = torch.topk(pre, k=k, dim=-1, out=out)
+        vals.relu_()
+        return pre.zero_().scatter_(-1, idx, vals).view(*lead, -1)
 
     def forward(self, x: torch.Tensor) -> tuple[torch.Tensor, torch.Tensor]:
+        if self.sparsity_mode == "topk":
+            vals, idx = self.encode_topk(x)
+            return self.decode_sparse(vals, idx), self._densify(vals, idx)
         h = self.encode(x)
-        recon = self.decoder(h)
+        recon = self.decode(h)
         return recon, h
 
 
@@ -39,10 +162,94 @@ class LossOutput:
     total: torch.Tensor
     recon: torch.Tensor
     l1: torch.Tensor
+    codes: torch.Tensor | None = None
 
 
 def sae_loss(x: torch.Tensor, recon: torch.Tensor, h: torch.Tensor, l1_coeff: float) -> LossOutput:
     recon_loss = F.mse_loss(recon.float(), x.float())
     l1 = h.abs().mean()
     total = recon_loss + l1_coeff * l1
+    return LossOutput(total=total, recon=recon_loss, l1=l1, codes=h)
+
+
+class StackedSparseAutoencoder(nn.Module):
+    """
+    N independent SAEs over the same input, stored as stacked [N, ...] weights and run with bmm.
+
+    Models may differ in d_sae (padded to the largest; padded latents are masked to zero and
+    never receive gradient) and topk; sparsity_mode is shared. `export(i)` returns a
+    SparseAutoencoder-compatible state_dict for model i.
+    """
+
+    def __init__(self, d_model: int, d_saes: list[int], sparsity_mode: str = "relu_l1", topks: list[int] | None = None):
+        super().__init__()
+        n, width = len(d_saes), max(d_saes)
+        self.d_model = d_model
+        self.d_saes = list(d_saes)
+        self.sparsity_mode = sparsity_mode
+        self.topks = list(topks) if topks is not None else [64] * n
+        self.W_enc = nn.Parameter(torch.zeros(n, d_model, width))
+        self.b_enc = nn.Parameter(torch.zeros(n, width))
+        self.W_dec = nn.Parameter(torch.zeros(n, width, d_model))
+        self.b_pre = nn.Parameter(torch.zeros(n, d_model), requires_grad=False)
+        self.register_buffer("latent_mask", torch.arange(width)[None, :] < torch.tensor(self.d_saes)[:, None], persistent=False)
+        self.register_buffer("k_per_model", torch.tensor([min(k, d) for k, d in zip(self.topks, self.d_saes)]), persistent=False)
+
+    @classmethod
+    def from_modules(cls, saes: list[SparseAutoencoder]) -> "StackedSparseAutoencoder":
+        modes = {sae.sparsity_mode for sae in saes}
+        if len(modes) != 1:
+            raise ValueError(f"Stacked SAEs must share sparsity_mode, got {sorted(modes)}.")
+        stacked = cls(
+            d_model=saes[0].encoder.in_features,
+            d_saes=[sae.encoder.out_features for sae in saes],
+            sparsity_mode=modes.pop(),
+            topks=[sae.topk for sae in saes],
+        )
+        with torch.no_grad():
+            for i, sae in enumerate(saes):
+                d = sae.encoder.out_features
+                stacked.W_enc[i, :, :d] = sae.encoder.weight.t()
+                stacked.b_enc[i, :d] = sae.encoder.bias
+                stacked.W_dec[i, :d, :] = sae.decoder.weight.t()
+                stacked.b_pre[i] = sae.b_pre
+        stacked.b_pre.requires_grad_(any(sae.b_pre.requires_grad for sae in saes))
+        return stacked
+
+    @torch.no_grad()
+    def normalize_decoder_(self) -> None:
+        """Project every model's decoder rows (one per latent) back to unit L2 norm; padding stays zero."""
+        self.W_dec.div_(self.W_dec.norm(dim=-1, keepdim=True).clamp_min(1e-8))
+
+    def export(self, i: int) -> dict[str, torch.Tensor]:
+        d = self.d_saes[i]
+        return {
+            "encoder.weight": self.W_enc[i, :, :d].t().detach().clone(),
+            "encoder.bias": self.b_enc[i, :d].detach().clone(),
+            "decoder.weight": self.W_dec[i, :d, :].t().detach().clone(),
+            "b_pre": self.b_pre[i].detach().clone(),
+        }
+
+    def encode(self, x: torch.Tensor) -> torch.Tensor:
+        """x: [B, d_model] -> codes [N, B, width] (zero beyond each model's d_sae)."""
+        pre = torch.baddbmm(self.b_enc.unsqueeze(1), x.unsqueeze(0) - self.b_pre.unsqueeze(1), self.W_enc)
+        pre = pre.masked_fill(~self.latent_mask.unsqueeze(1), float("-inf"))
+        if self.sparsity_mode != "topk":
+            return F.relu(pre)
+        kmax = int(self.k_per_model.max())
+        vals, idx = torch.topk(pre, k=kmax, dim=-1)
+        keep = torch.arange(kmax, device=x.device)[None, None, :] < self.k_per_model[:, None, None]
+        vals = F.relu(vals) * keep
+        return torch.zeros_like(pre, dtype=vals.dtype).scatter(-1, idx, vals)
+
+    def forward(self, x: torch.Tensor) -> tuple[torch.Tensor, torch.Tensor]:
+        h = self.encode(x)
+        return torch.baddbmm(self.b_pre.unsqueeze(1), h, self.W_dec), h
+
+
+def stacked_sae_loss(x: torch.Tensor, recon: torch.Tensor, h: torch.Tensor, l1_coeffs: torch.Tensor, d_saes: torch.Tensor) -> LossOutput:
+    """Per-model losses for a StackedSparseAutoencoder; `recon`/`l1` are [N], `total` sums them."""
+    recon_loss = (recon.float() - x.float().unsqueeze(0)).pow(2).mean(dim=(1, 2))
+    l1 = h.abs().sum(dim=(1, 2)) / (h.shape[1] * d_saes)
+    total = (recon_loss + l1_coeffs * l1).sum()
     return LossOutput(total=total, recon=recon_loss, l1=l1)
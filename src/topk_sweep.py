@@ -86,19 +86,30 @@ if __name__ == "__main__":
     ap.add_argument("--config", required=True)
     ap.add_argument("--layers", default="0,1,2,3,4,5")
     ap.add_argument("--topks", default="24,16")
+    ap.add_argument("--batched", action="store_true", help="Train all k for a layer in one src.train_sae_multi pass.")
     args = ap.parse_args()
 
     base = read_yaml(Path(args.config))
     layers = [int(x) for x in args.layers.split(",") if x.strip()]
     topks = [int(x) for x in args.topks.split(",") if x.strip()]
 
-    for k in topks:
+    def analyze(cfgp: Path) -> None:
+        run(["python", "-m", "src.interpret", "--config", str(cfgp), "--label", "A"])
+        run(["python", "-m", "src.interpret", "--config", str(cfgp), "--label", "B"])
+        run(["python", "-m", "src.eval", "--config", str(cfgp)])
+        run(["python", "-m", "src.viz", "--config", str(cfgp)])
+
+    if args.batched:
         for layer in layers:
-            cfgp = make_cfg(base, layer, k)
-            run(["python", "-m", "src.train_sae", "--config", str(cfgp)])
-            run(["python", "-m", "src.interpret", "--config", str(cfgp), "--label", "A"])
-            run(["python", "-m", "src.interpret", "--config", str(cfgp), "--label", "B"])
-            run(["python", "-m", "src.eval", "--config", str(cfgp)])
-            run(["python", "-m", "src.viz", "--config", str(cfgp)])
+            cfgps = [make_cfg(base, layer, k) for k in topks]
+            run(["python", "-m", "src.train_sae_multi", "--configs", *map(str, cfgps)])
+            for cfgp in cfgps:
+                analyze(cfgp)
+    else:
+        for k in topks:
+            for layer in layers:
+                cfgp = make_cfg(base, layer, k)
+                run(["python", "-m", "src.train_sae", "--config", str(cfgp)])
+                analyze(cfgp)
 
     summarize(topks, layers)
@@ -2,96 +2,404 @@ from __future__ import annotations
 
 import argparse
 import json
+import os
+import re
+import socket
+import time
 from pathlib import Path
 
 import numpy as np
 import pandas as pd
 import torch
-from torch.utils.data import DataLoader, TensorDataset
+import torch.distributed as dist
+from torch.nn.parallel import DistributedDataParallel
 from tqdm import tqdm
 
+from .activation_store import ActivationStore, BlockShuffleSampler, open_label_store
 from .config import load_config
-from .sae import SparseAutoencoder, sae_loss
-from .utils import get_device, set_seed
+from .sae import LossOutput, SparseAutoencoder, sae_loss
+from .utils import get_device, get_rng_state, set_rng_state, set_seed, torch_save_atomic
 
 
-def _train_one(cfg, label: str) -> dict:
+def _world() -> tuple[int, int]:
+    """(rank, world_size) of the data-parallel process group, or (0, 1) when not distributed."""
+    if dist.is_available() and dist.is_initialized():
+        return dist.get_rank(), dist.get_world_size()
+    return 0, 1
+
+
+def _all_reduce(t: torch.Tensor, op: str = "sum") -> torch.Tensor:
+    """In-place all-reduce across data-parallel ranks; a no-op in single-process training."""
+    if _world()[1] > 1:
+        dist.all_reduce(t, op=dist.ReduceOp.MAX if op == "max" else dist.ReduceOp.SUM)
+    return t
+
+
+_AUTOCAST_DTYPES = {"fp32": None, "bf16": torch.bfloat16, "fp16": torch.float16}
+
+
+def _build_loss_fn(model, sae_cfg, device: torch.device, criterion=None):
+    """
+    Forward + loss under the configured autocast precision, compiled when `sae.compile` is set.
+
+    `criterion(xb, recon, h)` defaults to `sae_loss` with `sae.l1_coeff`.
+    """
+    if sae_cfg.precision not in _AUTOCAST_DTYPES:
+        raise ValueError(f"Unknown sae.precision={sae_cfg.precision!r}; expected one of {sorted(_AUTOCAST_DTYPES)}.")
+    dtype = _AUTOCAST_DTYPES[sae_cfg.precision]
+    if criterion is None:
+        def criterion(xb, recon, h):
+            return sae_loss(xb, recon, h, sae_cfg.l1_coeff)
+
+    def forward_loss(xb: torch.Tensor) -> LossOutput:
+        with torch.autocast(device_type=device.type, dtype=dtype or torch.float32, enabled=dtype is not None):
+            recon, h = model(xb)
+        return criterion(xb, recon, h)
+
+    if not sae_cfg.compile:
+        return forward_loss
+    state = {"fn": torch.compile(forward_loss)}
+
+    def compiled_or_eager(xb: torch.Tensor) -> LossOutput:
+        try:
+            return state["fn"](xb)
+        except Exception as exc:
+            if state["fn"] is forward_loss:
+                raise
+            print(f"torch.compile unavailable on {device.type} ({type(exc).__name__}: {exc}); training eagerly.")
+            state["fn"] = forward_loss
+            return forward_loss(xb)
+
+    return compiled_or_eager
+
+
+def _make_scaler(sae_cfg, device: torch.device) -> torch.amp.GradScaler:
+    # fp16 gradients need loss scaling; bf16 has fp32's exponent range and does not.
+    return torch.amp.GradScaler(device.type, enabled=sae_cfg.precision == "fp16" and device.type == "cuda")
+
+
+def _train_step(model, optim, sched, scaler, loss_fn, xb: torch.Tensor, grad_clip: float) -> LossOutput:
+    loss_out = loss_fn(xb)
+
+    optim.zero_grad(set_to_none=True)
+    scaler.scale(loss_out.total).backward()
+    scaler.unscale_(optim)
+    torch.nn.utils.clip_grad_norm_(model.parameters(), grad_clip)
+    scaler.step(optim)
+    scaler.update()
+    sched.step()
+    return loss_out
+
+
+def _accumulate(sums: torch.Tensor, loss_out: LossOutput, n: int) -> None:
+    """Add batch-weighted (recon, l1) into a device-side running sum without a host sync."""
+    sums += torch.stack((loss_out.recon.detach(), loss_out.l1.detach())).float() * n
+
+
+def _init_b_pre(store: ActivationStore, stop: int, chunk_rows: int, device: torch.device, method: str, iters: int) -> torch.Tensor:
+    """
+    Mean or geometric median of rows [0, stop), streamed from the store in chunks.
+
+    The geometric median runs Weiszfeld iterations from the mean, one streaming pass each,
+    stopping early once the estimate moves by less than 1e-5 (relative).
+    """
+    if method not in ("mean", "geometric_median"):
+        raise ValueError(f"Unknown sae.b_pre_init={method!r}; expected 'zero', 'mean' or 'geometric_median'.")
+
+    def weighted_mean(weights) -> torch.Tensor:
+        num = torch.zeros(store.d_model, dtype=torch.float64)
+        den = torch.zeros((), dtype=torch.float64)
+        for _, chunk in store.iter_chunks(chunk_rows, 0, stop):
+            x = torch.from_numpy(np.array(chunk)).to(device).float()
+            w = weights(x)
+            num += (w[:, None] * x).sum(dim=0).cpu().double()
+            den += w.sum().cpu().double()
+        return (num / den.clamp_min(1e-12)).float()
+
+    center = weighted_mean(lambda x: torch.ones(x.shape[0], device=device))
+    if method == "mean":
+        return center
+    for _ in range(iters):
+        c = center.to(device)
+        new = weighted_mean(lambda x: 1.0 / (x - c).norm(dim=-1).clamp_min(1e-6))
+        shift = float((new - center).norm() / center.norm().clamp_min(1e-8))
+        center = new
+        if shift < 1e-5:
+            break
+    return center
+
+
+def _resample_dead(model: SparseAutoencoder, optim, dead: torch.Tensor, xb: torch.Tensor) -> int:
+    """
+    Re-initialize dead latents toward inputs the SAE reconstructs badly.
+
+    Rows of `xb` are drawn with probability proportional to their squared reconstruction error
+    squared; each dead latent gets the normalized row as its decoder column and a scaled copy as
+    its encoder row (bias 0), and its AdamW moments are reset. Under data parallelism the
+    directions come from rank 0's batch and are broadcast so replicas stay identical.
+    """
+    idx = dead.nonzero().flatten()
+    if idx.numel() == 0:
+        return 0
+    rank, world_size = _world()
+    with torch.no_grad():
+        dirs = torch.empty(idx.numel(), xb.shape[-1], device=xb.device)
+        if rank == 0:
+            recon, _ = model(xb)
+            err = (xb - recon.float()).pow(2).sum(dim=-1)
+            rows = torch.multinomial(err.pow(2) + 1e-12, idx.numel(), replacement=True)
+            centered = xb[rows] - model.b_pre
+            dirs = centered / centered.norm(dim=-1, keepdim=True).clamp_min(1e-8)
+        if world_size > 1:
+            dist.broadcast(dirs, src=0)
+        alive_norm = model.encoder.weight[~dead].norm(dim=-1).mean() if bool((~dead).any()) else torch.tensor(1.0)
+        model.decoder.weight[:, idx] = dirs.t()
+        model.encoder.weight[idx] = dirs * (0.2 * alive_norm)
+        model.encoder.bias[idx] = 0.0
+        for param, index in ((model.encoder.weight, (idx,)), (model.encoder.bias, (idx,)), (model.decoder.weight, (slice(None), idx))):
+            state = optim.state.get(param, {})
+            for key in ("exp_avg", "exp_avg_sq"):
+                if key in state:
+                    state[key][index] = 0.0
+    return idx.numel()
+
+
+def _still_moving(prev: dict | None, row: dict, min_delta: float) -> bool:
+    """True when val L0 (relative) or dead fraction (absolute) changed by more than min_delta."""
+    if prev is None:
+        return True
+    l0_change = abs(row["val_l0"] - prev["val_l0"]) / max(abs(prev["val_l0"]), 1e-8)
+    return l0_change > min_delta or abs(row["dead_frac"] - prev["dead_frac"]) > min_delta
+
+
+def _step_checkpoints(ckpt_dir: Path, label: str, kind: str = "step") -> list[tuple[int, Path]]:
+    """Existing `sae_{label}_{kind}{N}.pt` files, oldest first ("step": resumable full state,
+    "weights_step": weights-only snapshots from src.train_sae_multi)."""
+    pattern = re.compile(rf"sae_{re.escape(label)}_{kind}(\d+)\.pt")
+    found = [(int(m.group(1)), p) for p in ckpt_dir.glob(f"sae_{label}_{kind}*.pt") if (m := pattern.fullmatch(p.name))]
+    return sorted(found)
+
+
+def _prune_step_checkpoints(ckpt_dir: Path, label: str, keep: int, kind: str = "step") -> None:
+    if keep <= 0:
+        return
+    for _, path in _step_checkpoints(ckpt_dir, label, kind)[:-keep]:
+        path.unlink(missing_ok=True)
+
+
+def _clear_checkpoints(ckpt_dir: Path, label: str) -> None:
+    """Delete a label's step, weights-only step and best checkpoints, so a fresh run neither prunes
+    its own steps in favour of higher-numbered ones from an earlier run nor is later resumed from them."""
+    for kind in ("step", "weights_step"):
+        for _, path in _step_checkpoints(ckpt_dir, label, kind):
+            path.unlink(missing_ok=True)
+    (ckpt_dir / f"sae_{label}_best.pt").unlink(missing_ok=True)
+
+
+def _train_one(cfg, label: str, resume: bool = False) -> dict:
     acts_dir = Path(cfg.collection.output_dir)
     ckpt_dir = Path(cfg.outputs.checkpoints_dir)
     table_dir = Path(cfg.outputs.tables_dir)
     ckpt_dir.mkdir(parents=True, exist_ok=True)
     table_dir.mkdir(parents=True, exist_ok=True)
 
-    with open(acts_dir / f"meta_{label}.json", "r", encoding="utf-8") as f:
-        meta = json.load(f)
-
-    n = int(meta["tokens_collected"])
-    d_model = int(meta["d_model"])
-    arr = np.memmap(meta["acts_path"], mode="r", dtype=np.float16, shape=(cfg.collection.__dict__[f'tokens_{label.lower()}'], d_model))
-    x = np.array(arr[:n], dtype=np.float32)
-
+    store, _ = open_label_store(acts_dir, label, cfg)
+    n = len(store)
+    d_model = store.d_model
     split = int(0.9 * n)
-    x_train = torch.from_numpy(x[:split])
-    x_val = torch.from_numpy(x[split:])
-
-    train_loader = DataLoader(TensorDataset(x_train), batch_size=cfg.sae.batch_size, shuffle=True)
-    val_loader = DataLoader(TensorDataset(x_val), batch_size=cfg.sae.batch_size, shuffle=False)
 
-    device = get_device(cfg.device_preference)
+    # Data-parallel ranks (gloo) run on CPU, each on its own share of blocks; sae.batch_size
+    # stays the global batch.
+    rank, world_size = _world()
+    is_main = rank == 0
+    device = torch.device("cpu") if world_size > 1 else get_device(cfg.device_preference)
+    sampler_kwargs = dict(
+        batch_size=max(cfg.sae.batch_size // world_size, 1),
+        block_rows=cfg.sae.block_rows,
+        buffer_rows=cfg.sae.chunk_rows,
+        device=device,
+        seed=cfg.seed,
+        rank=rank,
+        world_size=world_size,
+    )
+    train_sampler = BlockShuffleSampler(store, 0, split, **sampler_kwargs)
+    val_sampler = BlockShuffleSampler(store, split, n, shuffle=False, equalize=False, **sampler_kwargs)
+    if len(train_sampler.blocks) < world_size:
+        raise ValueError(
+            f"{len(train_sampler.blocks)} training blocks cannot be shared by {world_size} ranks; lower sae.block_rows."
+        )
+    dropped = train_sampler.dropped_rows()
+    if is_main and dropped > 0.01 * split:
+        print(
+            f"[warn] {dropped} of {split} training rows per epoch are skipped to give all {world_size} ranks "
+            "the same batch count; lower sae.block_rows to shrink this."
+        )
     model = SparseAutoencoder(
         d_model=d_model,
         d_sae=cfg.sae.d_sae,
         sparsity_mode=cfg.sae.sparsity_mode,
         topk=cfg.sae.topk,
     ).to(device)
+    previous = _step_checkpoints(ckpt_dir, label) if resume else []
+    if cfg.sae.b_pre_init != "zero":
+        model.b_pre.requires_grad_(True)
+        if not previous and is_main:
+            model.b_pre.data.copy_(
+                _init_b_pre(store, split, cfg.sae.chunk_rows, device, cfg.sae.b_pre_init, cfg.sae.b_pre_median_iters)
+            )
+    if cfg.sae.decoder_unit_norm:
+        model.normalize_decoder_()
+    # DDP broadcasts rank 0's parameters (init, b_pre) on wrap and all-reduces gradients.
+    train_model = DistributedDataParallel(model) if world_size > 1 else model
 
     optim = torch.optim.AdamW(
         model.parameters(),
         lr=cfg.sae.lr,
         weight_decay=cfg.sae.weight_decay,
     )
-    total_steps = cfg.sae.epochs * max(len(train_loader), 1)
+    total_steps = sum(train_sampler.num_batches(epoch) for epoch in range(cfg.sae.epochs))
     sched = torch.optim.lr_scheduler.CosineAnnealingLR(optim, T_max=max(total_steps, 1))
+    scaler = _make_scaler(cfg.sae, device)
+    loss_fn = _build_loss_fn(train_model, cfg.sae, device)
+    eval_loss_fn = _build_loss_fn(model, cfg.sae, device) if world_size > 1 else loss_fn
 
+    # Step at which each latent last fired (init counts as firing), kept on the device.
+    last_fired = torch.zeros(cfg.sae.d_sae, dtype=torch.long, device=device)
+    resampled = 0
+    # Early-stopping state: best val_recon so far and epochs without progress.
+    monitor = {"best_val_recon": float("inf"), "best_epoch": 0, "stale": 0, "stopped": False}
+    best_ckpt = ckpt_dir / f"sae_{label}_best.pt"
     logs = []
     step = 0
-    for epoch in range(cfg.sae.epochs):
-        model.train()
-        train_recon = 0.0
-        train_l1 = 0.0
-        count = 0
-        pbar = tqdm(train_loader, desc=f"train {label} e{epoch+1}/{cfg.sae.epochs}")
-        for (xb,) in pbar:
-            xb = xb.to(device)
-            recon, h = model(xb)
-            loss_out = sae_loss(xb, recon, h, cfg.sae.l1_coeff)
+    start_epoch = 0
+    cursor = None
+    if previous:
+        state = torch.load(previous[-1][1], map_location=device, weights_only=False)
+        if "total_steps" not in state:
+            raise ValueError(
+                f"{previous[-1][1]} holds SAE weights only (e.g. from an older src.train_sae_multi), not a "
+                "resumable training state; rerun without --resume."
+            )
+        if state["total_steps"] != total_steps:
+            raise ValueError(
+                f"{previous[-1][1]} was written for {state['total_steps']} total steps, this config has {total_steps}."
+            )
+        model.load_state_dict(state["model"])
+        optim.load_state_dict(state["optim"])
+        sched.load_state_dict(state["sched"])
+        scaler.load_state_dict(state["scaler"])
+        set_rng_state(state["rng"])
+        last_fired = state["last_fired"].to(device)
+        resampled = state["resampled"]
+        monitor = state["monitor"]
+        logs = state["logs"]
+        step = state["step"]
+        start_epoch = cfg.sae.epochs if monitor["stopped"] else state["epoch"]
+        cursor = state["cursor"]
+        if is_main:
+            print(f"Resuming {label} from {previous[-1][1]} (epoch {state['epoch'] + 1}, step {step}).")
 
-            optim.zero_grad(set_to_none=True)
-            loss_out.total.backward()
-            torch.nn.utils.clip_grad_norm_(model.parameters(), cfg.sae.grad_clip)
-            optim.step()
-            sched.step()
+    def save_step_checkpoint(epoch: int, epoch_cursor: dict | None) -> None:
+        # Collectives first (every rank reaches the same checkpoint steps), then rank 0 writes.
+        fired = _all_reduce(last_fired.clone(), "max")
+        if epoch_cursor is not None and world_size > 1:
+            epoch_cursor = {
+                **epoch_cursor,
+                "train_sums": _all_reduce(epoch_cursor["train_sums"].clone()),
+                "count": int(_all_reduce(torch.tensor(epoch_cursor["count"]))),
+            }
+        if not is_main:
+            return
+        torch_save_atomic(
+            {
+                "model": model.state_dict(),
+                "optim": optim.state_dict(),
+                "sched": sched.state_dict(),
+                "scaler": scaler.state_dict(),
+                "rng": get_rng_state(),
+                "last_fired": fired.cpu(),
+                "resampled": resampled,
+                "monitor": monitor,
+                "logs": logs,
+                "step": step,
+                "epoch": epoch,
+                "cursor": epoch_cursor,
+                "total_steps": total_steps,
+            },
+            ckpt_dir / f"sae_{label}_step{step}.pt",
+        )
+        _prune_step_checkpoints(ckpt_dir, label, cfg.sae.keep_checkpoints)
 
-            train_recon += float(loss_out.recon.item()) * xb.shape[0]
-            train_l1 += float(loss_out.l1.item()) * xb.shape[0]
+    for epoch in range(start_epoch, cfg.sae.epochs):
+        model.train()
+        train_sums = torch.zeros(2, device=device)
+        count = 0
+        start_batch = 0
+        prior_sec = 0.0
+        if cursor is not None:
+            # The cursor holds sums over all ranks; rank 0 carries them, the others restart at zero.
+            if is_main:
+                train_sums = cursor["train_sums"].to(device)
+                count = cursor["count"]
+            start_batch = cursor["batch"]
+            prior_sec = cursor["train_sec"]
+            cursor = None
+        t0 = time.perf_counter()
+        pbar = tqdm(
+            train_sampler.iter_epoch(epoch, start_batch=start_batch),
+            total=train_sampler.num_batches(epoch),
+            initial=start_batch,
+            desc=f"train {label} e{epoch+1}/{cfg.sae.epochs}",
+            disable=not is_main,
+        )
+        for batch, xb in enumerate(pbar, start=start_batch + 1):
+            loss_out = _train_step(train_model, optim, sched, scaler, loss_fn, xb, cfg.sae.grad_clip)
+            if cfg.sae.decoder_unit_norm:
+                model.normalize_decoder_()
+            _accumulate(train_sums, loss_out, xb.shape[0])
             count += xb.shape[0]
             step += 1
+            last_fired = torch.where((loss_out.codes > 0).any(dim=0), step, last_fired)
+            if cfg.sae.resample_every > 0 and step % cfg.sae.resample_every == 0:
+                dead = step - _all_reduce(last_fired, "max") >= cfg.sae.dead_after_steps
+                n_resampled = _resample_dead(model, optim, dead, xb)
+                last_fired = torch.where(dead, step, last_fired)
+                resampled += n_resampled
+            if cfg.sae.log_every > 0 and step % cfg.sae.log_every == 0:
+                recon_avg, l1_avg = (train_sums / count).tolist()
+                pbar.set_postfix(recon=f"{recon_avg:.4g}", l1=f"{l1_avg:.4g}")
             if step % cfg.sae.checkpoint_every == 0:
-                torch.save(model.state_dict(), ckpt_dir / f"sae_{label}_step{step}.pt")
+                save_step_checkpoint(
+                    epoch,
+                    {
+                        "batch": batch,
+                        "train_sums": train_sums.cpu(),
+                        "count": count,
+                        "train_sec": prior_sec + time.perf_counter() - t0,
+                    },
+                )
+        if world_size > 1:
+            _all_reduce(train_sums)
+            count = int(_all_reduce(torch.tensor(count)))
+        train_recon, train_l1 = train_sums.tolist()
+        train_sec = prior_sec + time.perf_counter() - t0
 
         model.eval()
-        val_recon = 0.0
-        val_l1 = 0.0
+        val_sums = torch.zeros(2, device=device)
+        val_active = torch.zeros((), device=device)
         vcount = 0
         with torch.no_grad():
-            for (xb,) in val_loader:
-                xb = xb.to(device)
-                recon, h = model(xb)
-                out = sae_loss(xb, recon, h, cfg.sae.l1_coeff)
-                val_recon += float(out.recon.item()) * xb.shape[0]
-                val_l1 += float(out.l1.item()) * xb.shape[0]
+            for xb in val_sampler.iter_epoch():
+                out = eval_loss_fn(xb)
+                _accumulate(val_sums, out, xb.shape[0])
+                val_active += (out.codes > 0).sum()
                 vcount += xb.shape[0]
+        if world_size > 1:
+            _all_reduce(val_sums)
+            _all_reduce(val_active)
+            vcount = int(_all_reduce(torch.tensor(vcount)))
 
+        val_recon, val_l1 = val_sums.tolist()
         row = {
             "label": label,
             "epoch": epoch + 1,
@@ -99,13 +407,38 @@ def _train_one(cfg, label: str) -> dict:
             "train_l1": train_l1 / max(count, 1),
             "val_recon": val_recon / max(vcount, 1),
             "val_l1": val_l1 / max(vcount, 1),
+            "val_l0": float(val_active) / max(vcount, 1),
             "lr": sched.get_last_lr()[0],
+            "tokens_per_sec": count / max(train_sec, 1e-9),
+            "dead_frac": float((step - _all_reduce(last_fired, "max") >= cfg.sae.dead_after_steps).float().mean()),
+            "resampled_total": resampled,
         }
+        improved = row["val_recon"] < monitor["best_val_recon"] * (1.0 - cfg.sae.early_stop_min_delta)
+        moving = _still_moving(logs[-1] if logs else None, row, cfg.sae.early_stop_min_delta)
+        monitor["stale"] = 0 if improved or moving else monitor["stale"] + 1
+        if row["val_recon"] < monitor["best_val_recon"]:
+            monitor["best_val_recon"] = row["val_recon"]
+            monitor["best_epoch"] = epoch + 1
+            if cfg.sae.early_stop_patience > 0 and is_main:
+                torch_save_atomic(model.state_dict(), best_ckpt)
+        row["stale_epochs"] = monitor["stale"]
+        monitor["stopped"] = cfg.sae.early_stop_patience > 0 and monitor["stale"] >= cfg.sae.early_stop_patience
         logs.append(row)
-        print(row)
+        if is_main:
+            print(row)
+        save_step_checkpoint(epoch + 1, None)
+        if monitor["stopped"] and is_main:
+            print(f"Early stop {label} after epoch {epoch + 1}: converged for {monitor['stale']} epochs.")
+        if monitor["stopped"]:
+            break
+
+    if not is_main:
+        return {}
+    if cfg.sae.early_stop_patience > 0 and best_ckpt.exists():
+        model.load_state_dict(torch.load(best_ckpt, map_location=device))
 
     final_ckpt = ckpt_dir / f"sae_{label}.pt"
-    torch.save(model.state_dict(), final_ckpt)
+    torch_save_atomic(model.state_dict(), final_ckpt)
 
     log_path = table_dir / f"train_log_{label}.csv"
     pd.DataFrame(logs).to_csv(log_path, index=False)
@@ -116,22 +449,70 @@ def _train_one(cfg, label: str) -> dict:
         "train_log_csv": str(log_path),
         "d_model": d_model,
         "d_sae": cfg.sae.d_sae,
+        "epochs_run": len(logs),
+        "best_epoch": monitor["best_epoch"],
     }
 
 
+def _run(config_path: str, resume: bool) -> None:
+    cfg = load_config(config_path)
+    set_seed(cfg.seed)
+    if not resume and _world()[0] == 0:
+        for label in ["A", "B"]:
+            _clear_checkpoints(Path(cfg.outputs.checkpoints_dir), label)
+
+    out_a = _train_one(cfg, "A", resume=resume)
+    out_b = _train_one(cfg, "B", resume=resume)
+
+    if _world()[0] == 0:
+        with open(Path(cfg.outputs.root) / "train_meta.json", "w", encoding="utf-8") as f:
+            json.dump({"A": out_a, "B": out_b}, f, indent=2)
+
+
+def _spawned_worker(rank: int, world_size: int, port: int, config_path: str, resume: bool) -> None:
+    os.environ["MASTER_ADDR"] = "127.0.0.1"
+    os.environ["MASTER_PORT"] = str(port)
+    # Split the node's cores between workers instead of oversubscribing intra-op threads.
+    torch.set_num_threads(max((os.cpu_count() or 1) // world_size, 1))
+    dist.init_process_group("gloo", rank=rank, world_size=world_size)
+    try:
+        _run(config_path, resume)
+    finally:
+        dist.destroy_process_group()
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
 def main() -> None:
     parser = argparse.ArgumentParser()
     parser.add_argument("--config", required=True)
+    parser.add_argument("--resume", action="store_true", help="Continue from the latest sae_{label}_step*.pt checkpoint.")
+    parser.add_argument(
+        "--nproc",
+        type=int,
+        default=1,
+        help="Data-parallel CPU worker processes (gloo DDP) on this node. Under torchrun the launcher's world is used.",
+    )
     args = parser.parse_args()
 
-    cfg = load_config(args.config)
-    set_seed(cfg.seed)
-
-    out_a = _train_one(cfg, "A")
-    out_b = _train_one(cfg, "B")
-
-    with open(Path(cfg.outputs.root) / "train_meta.json", "w", encoding="utf-8") as f:
-        json.dump({"A": out_a, "B": out_b}, f, indent=2)
+    if int(os.environ.get("WORLD_SIZE", "1")) > 1:
+        dist.init_process_group("gloo")
+        try:
+            _run(args.config, args.resume)
+        finally:
+            dist.destroy_process_group()
+    elif args.nproc > 1:
+        torch.multiprocessing.spawn(
+            _spawned_worker,
+            args=(args.nproc, _free_port(), args.config, args.resume),
+            nprocs=args.nproc,
+        )
+    else:
+        _run(args.config, args.resume)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,260 @@
+from __future__ import annotations
+
+import argparse
+import json
+import time
+from pathlib import Path
+
+import pandas as pd
+import torch
+from tqdm import tqdm
+
+from .activation_store import BlockShuffleSampler, open_label_store
+from .config import load_config
+from .sae import SparseAutoencoder, StackedSparseAutoencoder, stacked_sae_loss
+from .train_sae import (
+    _accumulate,
+    _build_loss_fn,
+    _clear_checkpoints,
+    _init_b_pre,
+    _make_scaler,
+    _prune_step_checkpoints,
+)
+from .utils import get_device, set_seed, torch_save_atomic
+
+# Settings that decide which rows each batch holds (or how the stack runs) and must agree across
+# configs. d_sae, topk, l1_coeff, lr, weight_decay, grad_clip, checkpoint_every and
+# keep_checkpoints may vary per config; UNSUPPORTED settings must stay off.
+SHARED_KEYS = [
+    ("seed",),
+    ("device_preference",),
+    ("collection", "output_dir"),
+    ("sae", "batch_size"),
+    ("sae", "epochs"),
+    ("sae", "chunk_rows"),
+    ("sae", "block_rows"),
+    ("sae", "sparsity_mode"),
+    ("sae", "precision"),
+    ("sae", "compile"),
+    ("sae", "log_every"),
+    ("sae", "decoder_unit_norm"),
+    ("sae", "b_pre_init"),
+    ("sae", "b_pre_median_iters"),
+]
+
+# src.train_sae features the stacked trainer does not implement, with their "off" value.
+UNSUPPORTED = {
+    "early_stop_patience": 0,
+    "resample_every": 0,
+}
+
+
+def _check_shared(cfgs: list) -> None:
+    for key in SHARED_KEYS:
+        values = []
+        for cfg in cfgs:
+            v = cfg
+            for part in key:
+                v = getattr(v, part)
+            values.append(v)
+        if len(set(values)) != 1:
+            raise ValueError(f"{'.'.join(key)} must match across configs for batched training, got {values}.")
+    for key, off in UNSUPPORTED.items():
+        values = [getattr(cfg.sae, key) for cfg in cfgs]
+        if any(v != off for v in values):
+            raise ValueError(f"Batched training does not support sae.{key} (got {values}); train these configs with src.train_sae.")
+
+
+def _per_model(values: list[float], device: torch.device) -> torch.Tensor:
+    return torch.tensor(values, dtype=torch.float32, device=device)
+
+
+def _clip_per_model(model: StackedSparseAutoencoder, max_norms: torch.Tensor) -> None:
+    """clip_grad_norm_ applied to each stacked model's slice of the gradients independently."""
+    grads = [p.grad for p in model.parameters() if p.grad is not None]
+    norms = torch.stack([g.pow(2).flatten(1).sum(dim=1) for g in grads]).sum(dim=0).sqrt()
+    coef = (max_norms / (norms + 1e-6)).clamp(max=1.0)
+    for g in grads:
+        g.mul_(coef.view(-1, *[1] * (g.dim() - 1)))
+
+
+def _train_step(model, optim, sched, scaler, loss_fn, xb, max_norms, lr_scale, weight_decay):
+    """
+    One AdamW step with per-model lr and weight decay.
+
+    The optimizer runs with lr = schedule factor and no decay; each model's update is then
+    rescaled by its own lr and decoupled decay applied, which equals running AdamW per model.
+    Steps the GradScaler skips leave every model unchanged.
+    """
+    loss_out = loss_fn(xb)
+
+    optim.zero_grad(set_to_none=True)
+    scaler.scale(loss_out.total).backward()
+    scaler.unscale_(optim)
+    _clip_per_model(model, max_norms)
+    factor = optim.param_groups[0]["lr"]
+    params = [p for p in model.parameters() if p.requires_grad]
+    before = [p.detach().clone() for p in params]
+    scale = scaler.get_scale()
+    scaler.step(optim)
+    scaler.update()
+    # a dropped fp16 loss scale means inf/nan gradients: the step was skipped, params are untouched
+    if scaler.get_scale() < scale:
+        sched.step()
+        return loss_out
+    with torch.no_grad():
+        for p, p0 in zip(params, before):
+            shape = (-1, *[1] * (p.dim() - 1))
+            lr = lr_scale.view(shape)
+            p.copy_(p0 + lr * (p - p0) - (factor * lr * weight_decay.view(shape)) * p0)
+    sched.step()
+    return loss_out
+
+
+def _train_stack(cfgs: list, label: str) -> list[dict]:
+    base = cfgs[0]
+    store, _ = open_label_store(Path(base.collection.output_dir), label, base)
+    n = len(store)
+    d_model = store.d_model
+    split = int(0.9 * n)
+
+    device = get_device(base.device_preference)
+    sampler_kwargs = dict(
+        batch_size=base.sae.batch_size,
+        block_rows=base.sae.block_rows,
+        buffer_rows=base.sae.chunk_rows,
+        device=device,
+        seed=base.seed,
+    )
+    train_sampler = BlockShuffleSampler(store, 0, split, **sampler_kwargs)
+    val_sampler = BlockShuffleSampler(store, split, n, shuffle=False, **sampler_kwargs)
+
+    saes = [
+        SparseAutoencoder(d_model=d_model, d_sae=c.sae.d_sae, sparsity_mode=c.sae.sparsity_mode, topk=c.sae.topk)
+        for c in cfgs
+    ]
+    model = StackedSparseAutoencoder.from_modules(saes).to(device)
+    del saes
+    if base.sae.b_pre_init != "zero":
+        # The estimate depends only on the training rows, so every model starts from the same b_pre.
+        model.b_pre.requires_grad_(True)
+        model.b_pre.data.copy_(
+            _init_b_pre(store, split, base.sae.chunk_rows, device, base.sae.b_pre_init, base.sae.b_pre_median_iters)
+        )
+    if base.sae.decoder_unit_norm:
+        model.normalize_decoder_()
+
+    lr_scale = _per_model([c.sae.lr for c in cfgs], device)
+    weight_decay = _per_model([c.sae.weight_decay for c in cfgs], device)
+    max_norms = _per_model([c.sae.grad_clip for c in cfgs], device)
+    l1_coeffs = _per_model([c.sae.l1_coeff for c in cfgs], device)
+    d_saes = _per_model(model.d_saes, device)
+
+    optim = torch.optim.AdamW(model.parameters(), lr=1.0, weight_decay=0.0)
+    total_steps = sum(train_sampler.num_batches(epoch) for epoch in range(base.sae.epochs))
+    sched = torch.optim.lr_scheduler.CosineAnnealingLR(optim, T_max=max(total_steps, 1))
+    scaler = _make_scaler(base.sae, device)
+    loss_fn = _build_loss_fn(
+        model,
+        base.sae,
+        device,
+        criterion=lambda xb, recon, h: stacked_sae_loss(xb, recon, h, l1_coeffs, d_saes),
+    )
+
+    ckpt_dirs = [Path(c.outputs.checkpoints_dir) for c in cfgs]
+    for c in cfgs:
+        Path(c.outputs.checkpoints_dir).mkdir(parents=True, exist_ok=True)
+        Path(c.outputs.tables_dir).mkdir(parents=True, exist_ok=True)
+    for ckpt_dir in ckpt_dirs:
+        _clear_checkpoints(ckpt_dir, label)
+
+    logs: list[list[dict]] = [[] for _ in cfgs]
+    step = 0
+    for epoch in range(base.sae.epochs):
+        model.train()
+        train_sums = torch.zeros(2, len(cfgs), device=device)
+        count = 0
+        t0 = time.perf_counter()
+        pbar = tqdm(
+            train_sampler.iter_epoch(epoch),
+            total=train_sampler.num_batches(epoch),
+            desc=f"train x{len(cfgs)} {label} e{epoch+1}/{base.sae.epochs}",
+        )
+        for xb in pbar:
+            loss_out = _train_step(model, optim, sched, scaler, loss_fn, xb, max_norms, lr_scale, weight_decay)
+            if base.sae.decoder_unit_norm:
+                model.normalize_decoder_()
+            _accumulate(train_sums, loss_out, xb.shape[0])
+            count += xb.shape[0]
+            step += 1
+            if base.sae.log_every > 0 and step % base.sae.log_every == 0:
+                pbar.set_postfix(recon=" ".join(f"{v:.3g}" for v in (train_sums[0] / count).tolist()))
+            for i, c in enumerate(cfgs):
+                if step % c.sae.checkpoint_every == 0:
+                    torch_save_atomic(model.export(i), ckpt_dirs[i] / f"sae_{label}_weights_step{step}.pt")
+                    _prune_step_checkpoints(ckpt_dirs[i], label, c.sae.keep_checkpoints, kind="weights_step")
+        train_recon, train_l1 = train_sums.tolist()
+        train_sec = time.perf_counter() - t0
+
+        model.eval()
+        val_sums = torch.zeros(2, len(cfgs), device=device)
+        vcount = 0
+        with torch.no_grad():
+            for xb in val_sampler.iter_epoch():
+                _accumulate(val_sums, loss_fn(xb), xb.shape[0])
+                vcount += xb.shape[0]
+        val_recon, val_l1 = val_sums.tolist()
+
+        factor = sched.get_last_lr()[0]
+        for i, c in enumerate(cfgs):
+            row = {
+                "label": label,
+                "epoch": epoch + 1,
+                "train_recon": train_recon[i] / max(count, 1),
+                "train_l1": train_l1[i] / max(count, 1),
+                "val_recon": val_recon[i] / max(vcount, 1),
+                "val_l1": val_l1[i] / max(vcount, 1),
+                "lr": c.sae.lr * factor,
+                "tokens_per_sec": count / max(train_sec, 1e-9),
+            }
+            logs[i].append(row)
+            print(c.outputs.root, row)
+
+    outs = []
+    for i, c in enumerate(cfgs):
+        final_ckpt = ckpt_dirs[i] / f"sae_{label}.pt"
+        torch_save_atomic(model.export(i), final_ckpt)
+        log_path = Path(c.outputs.tables_dir) / f"train_log_{label}.csv"
+        pd.DataFrame(logs[i]).to_csv(log_path, index=False)
+        outs.append(
+            {
+                "label": label,
+                "checkpoint": str(final_ckpt),
+                "train_log_csv": str(log_path),
+                "d_model": d_model,
+                "d_sae": c.sae.d_sae,
+            }
+        )
+    return outs
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Train one SAE per config in a single pass over the activations.")
+    parser.add_argument("--configs", nargs="+", required=True)
+    args = parser.parse_args()
+
+    cfgs = [load_config(p) for p in args.configs]
+    _check_shared(cfgs)
+    set_seed(cfgs[0].seed)
+
+    outs_a = _train_stack(cfgs, "A")
+    outs_b = _train_stack(cfgs, "B")
+
+    for cfg, out_a, out_b in zip(cfgs, outs_a, outs_b):
+        Path(cfg.outputs.root).mkdir(parents=True, exist_ok=True)
+        with open(Path(cfg.outputs.root) / "train_meta.json", "w", encoding="utf-8") as f:
+            json.dump({"A": out_a, "B": out_b}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()